@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""Micro benchmarks for the patch generation and transport code.
+
+Usage:
+    python benchmark.py delta OLD NEW [OLD NEW ...]
+    python benchmark.py bisect [OLD NEW ...]
+    python benchmark.py encoding [OLD NEW ...]
+    python benchmark.py zdict [OLD NEW ...]
+    python benchmark.py fec [PATCH_SIZE]
+    python benchmark.py stream FIRMWARE_DIR OLD_VERSION NEW_VERSION
+    python benchmark.py uplink [COUNT]
+    python benchmark.py rendezvous [DEVICES] [RATE] [LOSS]
+
+OLD and NEW are either two versions of a file or two firmware directories,
+in which case every binary file present in both directories is compared.
+Without files, bisect, encoding and zdict run on generated sources. zdict
+trains the preset dictionary on the first OLD directory. fec simulates the
+delivery of a PATCH_SIZE bytes patch (default 2000) over lossy downlinks.
+stream compares the per file and update stream transfers of a release.
+uplink decodes COUNT (default 100000) MQTT uplinks of which a tenth are OTA
+messages of the fleet and reports the uplinks decoded per second.
+rendezvous queries DEVICES (default 500) simulated devices at RATE (default
+100) downlinks per second, a LOSS (default 0.5) share of the update info
+downlinks get no reply, with retry delays of 2 to 10 seconds. It runs in real
+time.
+"""
+
+import base64
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from utils import diff_match_patch as dmp_module
+from utils.binaryDelta import make_delta, apply_delta
+from utils.patchCodec import encode_patches, decode_patches
+from utils.zdict import build_zdict, register_zdicts, zdict_id, compress, decompress, ZDICT_LEVEL
+from utils.fragmentation import encode_fragments, FragmentDecoder
+from utils.groupUpdater import updateHandler, BINARY_EXT
+from utils.regions import max_payload
+from utils.uplink import UplinkDecoder, orjson
+from utils.rendezvous import Rendezvous
+from contextlib import redirect_stdout
+
+
+def _timed(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def _file_pairs(old, new, binary=True):
+    if os.path.isfile(old):
+        return [(old, new)]
+    pairs = []
+    for root, _, files in os.walk(new):
+        for f in sorted(files):
+            if (os.path.splitext(f)[1] in BINARY_EXT) != binary:
+                continue
+            new_path = os.path.join(root, f)
+            old_path = os.path.join(old, os.path.relpath(new_path, new))
+            if os.path.isfile(old_path):
+                pairs.append((old_path, new_path))
+    return pairs
+
+
+def bench_delta(args):
+    if len(args) == 0 or len(args) % 2:
+        print(__doc__)
+        return 1
+
+    print('{:<40} {:>9} {:>9} {:>9} {:>9} {:>10} {:>10}'.format(
+        'file', 'new', 'zlib', 'delta', 'zdelta', 'make MB/s', 'apply MB/s'))
+    totals = [0, 0, 0, 0]
+    for old, new in zip(args[::2], args[1::2]):
+        for old_path, new_path in _file_pairs(old, new):
+            with open(old_path, 'rb') as f:
+                source = f.read()
+            with open(new_path, 'rb') as f:
+                target = f.read()
+
+            delta, make_time = _timed(make_delta, source, target)
+            rebuilt, apply_time = _timed(apply_delta, source, delta)
+            if rebuilt != target:
+                print('{}: delta does not rebuild the target file'.format(new_path))
+                return 1
+
+            sizes = [len(target), len(zlib.compress(target)), len(delta), len(zlib.compress(delta))]
+            totals = [t + s for t, s in zip(totals, sizes)]
+            mb = (len(source) + len(target)) / 1e6
+            print('{:<40} {:>9} {:>9} {:>9} {:>9} {:>10.2f} {:>10.2f}'.format(
+                os.path.basename(new_path)[-40:], *sizes,
+                mb / max(make_time, 1e-9), len(target) / 1e6 / max(apply_time, 1e-9)))
+
+    print('{:<40} {:>9} {:>9} {:>9} {:>9}'.format('total', *totals))
+    return 0
+
+
+def _generated_sources(lines=3000, edits=60, moved_blocks=0, seed=0):
+    rnd = random.Random(seed)
+    words = ['self', 'def', 'return', 'lora', 'socket', 'import', 'pycom', 'machine', 'time', 'if', 'else', 'None']
+    old = ['    ' * rnd.randint(0, 3) + ' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 8))) + '\n'
+           for _ in range(lines)]
+    new = list(old)
+    for _ in range(edits):
+        i = rnd.randrange(len(new))
+        if rnd.random() < 0.5:
+            new[i] = new[i].replace(rnd.choice(words), rnd.choice(words))
+        else:
+            new.insert(i, rnd.choice(old))
+    if moved_blocks:
+        # reorganised file, blocks of lines moved around
+        size = len(new) // moved_blocks
+        blocks = [new[i:i + size] for i in range(0, len(new), size)]
+        rnd.shuffle(blocks)
+        new = [line for block in blocks for line in block]
+    return ''.join(old), ''.join(new)
+
+
+def bench_bisect(args):
+    if len(args) % 2:
+        print(__doc__)
+        return 1
+    if args:
+        pairs = []
+        for old_path, new_path in zip(args[::2], args[1::2]):
+            with open(old_path) as f_old, open(new_path) as f_new:
+                pairs.append((new_path, f_old.read(), f_new.read()))
+    else:
+        pairs = [('generated 3000 lines', *_generated_sources()),
+                 ('reorganised 1000 lines', *_generated_sources(lines=1000, moved_blocks=25))]
+
+    if dmp_module.numpy is None:
+        print('NumPy is not installed, diff_bisect always runs the pure Python implementation')
+        return 1
+
+    workloads = [
+        ('patch_make', lambda dmp, old, new: dmp.patch_toText(dmp.patch_make(old, new))),
+        ('char diff', lambda dmp, old, new: dmp.diff_main(old, new, False)),
+    ]
+    for name, old, new in pairs:
+        print(name)
+        for workload, func in workloads:
+            results = []
+            for fast in (False, True):
+                dmp = dmp_module.diff_match_patch()
+                # no deadline, both implementations must do the same work
+                dmp.Diff_Timeout = 0
+                dmp.Diff_FastBisect = fast
+                results.append(_timed(func, dmp, old, new, repeat=1))
+            if results[0][0] != results[1][0]:
+                print('  {}: output differs from the pure Python implementation'.format(workload))
+                return 1
+            print('  {:<12} python {:>8.3f} s  numpy {:>8.3f} s  x{:.2f}'.format(
+                workload, results[0][1], results[1][1], results[0][1] / results[1][1]))
+    return 0
+
+
+def _text_pairs(args):
+    pairs = []
+    for old, new in zip(args[::2], args[1::2]):
+        for old_path, new_path in _file_pairs(old, new, binary=False):
+            try:
+                with open(old_path) as f_old, open(new_path) as f_new:
+                    pairs.append((new_path, f_old.read(), f_new.read()))
+            except UnicodeDecodeError:
+                continue
+    return pairs
+
+
+def bench_encoding(args):
+    if len(args) % 2:
+        print(__doc__)
+        return 1
+    pairs = _text_pairs(args)
+    if not args:
+        pairs = [('generated 3000 lines', *_generated_sources()),
+                 ('generated 3000 lines, 200 edits', *_generated_sources(edits=200))]
+
+    dmp = dmp_module.diff_match_patch()
+    print('{:<40} {:>9} {:>9} {:>9} {:>9}'.format('file', 'text', 'ztext', 'binary', 'zbinary'))
+    totals = [0, 0, 0, 0]
+    for name, old, new in pairs:
+        patches = dmp.patch_make(old, new)
+        text = dmp.patch_toText(patches).encode()
+        binary = encode_patches(patches)
+        if dmp.patch_toText(decode_patches(binary)) != text.decode():
+            print('{}: binary patch does not decode to the same patches'.format(name))
+            return 1
+        sizes = [len(text), len(zlib.compress(text)), len(binary), len(zlib.compress(binary))]
+        totals = [t + s for t, s in zip(totals, sizes)]
+        print('{:<40} {:>9} {:>9} {:>9} {:>9}'.format(os.path.basename(name)[-40:], *sizes))
+    print('{:<40} {:>9} {:>9} {:>9} {:>9}'.format('total', *totals))
+    return 0
+
+
+def bench_zdict(args):
+    if len(args) % 2:
+        print(__doc__)
+        return 1
+    pairs = _text_pairs(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        train_dir = args[0] if args else tmp
+        if not args:
+            pairs = [('generated {} edits'.format(edits), *_generated_sources(edits=edits, seed=seed))
+                     for seed, edits in enumerate([5, 20, 60])]
+            # the devices run the old version, only that one can be in the dictionary
+            for i, (_, old, _) in enumerate(pairs):
+                with open(os.path.join(tmp, 'file{}.py'.format(i)), 'w') as f:
+                    f.write(old)
+        zdicts = dict((encoding, build_zdict(train_dir, encoding, BINARY_EXT)) for encoding in ('text', 'binary'))
+    register_zdicts(zdicts.values())
+
+    dmp = dmp_module.diff_match_patch()
+    print('dictionaries: ' + ', '.join('{} {} ({} bytes)'.format(encoding, zdict_id(zdict), len(zdict))
+                                       for encoding, zdict in zdicts.items()))
+    print('{:<40} {:>9} {:>9} {:>9} {:>9}'.format('file', 'ztext', 'ztext+d', 'zbinary', 'zbinary+d'))
+    totals = [0, 0, 0, 0]
+    for name, old, new in pairs:
+        patches = dmp.patch_make(old, new)
+        sizes = []
+        for encoding, data in (('text', dmp.patch_toText(patches).encode()), ('binary', encode_patches(patches))):
+            compressed = compress(data, zdict_id(zdicts[encoding]))
+            if decompress(compressed, zdicts[encoding]) != data:
+                print('{}: patch does not decompress with the dictionary'.format(name))
+                return 1
+            # same level, the gain is the dictionary's only
+            sizes += [len(zlib.compress(data, ZDICT_LEVEL)), len(compressed)]
+        totals = [t + s for t, s in zip(totals, sizes)]
+        print('{:<40} {:>9} {:>9} {:>9} {:>9}'.format(os.path.basename(name)[-40:], *sizes))
+    print('{:<40} {:>9} {:>9} {:>9} {:>9}'.format('total', *totals))
+    return 0
+
+
+FEC_FRAGMENT_SIZE = 228
+FEC_LOSS_RATES = [0.01, 0.05, 0.1, 0.2]
+FEC_REDUNDANCIES = [0, 0.1, 0.25, 0.5]
+FEC_TRIALS = 500
+
+
+def bench_fec(args):
+    size = int(args[0]) if args else 2000
+    rnd = random.Random(0)
+    data = bytes(rnd.getrandbits(8) for _ in range(size))
+
+    print('{} bytes patch, {} bytes fragments, {} trials'.format(size, FEC_FRAGMENT_SIZE, FEC_TRIALS))
+    print('{:<12}'.format('redundancy') + ''.join('{:>12}'.format('loss {:.0%}'.format(loss)) for loss in FEC_LOSS_RATES)
+          + '{:>10}'.format('frames'))
+    for redundancy in FEC_REDUNDANCIES:
+        fragments, padding = encode_fragments(data, FEC_FRAGMENT_SIZE, redundancy)
+        nb_frag = (size + padding) // FEC_FRAGMENT_SIZE
+        rates = []
+        for loss in FEC_LOSS_RATES:
+            delivered = 0
+            for _ in range(FEC_TRIALS):
+                decoder = FragmentDecoder(nb_frag, FEC_FRAGMENT_SIZE, padding)
+                for i, fragment in enumerate(fragments):
+                    if rnd.random() >= loss and decoder.add(i + 1, fragment):
+                        break
+                if decoder.complete():
+                    if decoder.data() != data:
+                        print('redundancy {}: decoded patch differs'.format(redundancy))
+                        return 1
+                    delivered += 1
+            rates.append(delivered / float(FEC_TRIALS))
+        print('{:<12}'.format(redundancy) + ''.join('{:>12.1%}'.format(r) for r in rates)
+              + '{:>10}'.format(len(fragments)))
+    return 0
+
+
+# $OTA,<type>,<data>,* at EU868 DR5
+STREAM_FRAGMENT_SIZE = max_payload('EU868', 5) - 9
+
+
+def bench_stream(args):
+    if len(args) != 3:
+        print(__doc__)
+        return 1
+    firmware_dir, old_version, new_version = args
+    handler = updateHandler(old_version, new_version, None, None, None, None, firmware_dir=firmware_dir)
+    with redirect_stdout(io.StringIO()):
+        handler.build_patches()
+
+    def frames(size):
+        return -(-size // STREAM_FRAGMENT_SIZE)
+
+    files = list(handler.patch_dict.values()) + list(handler.delta_dict.values())
+    deletes = sum(len(handler.oper_dict.get(key, [])) for key in ['delete_txt', 'delete_bin'])
+    # file name, fragments and checksum per file, one message per delete
+    file_size = sum(len(compressed) for compressed, _ in files)
+    file_frames = sum(2 + frames(len(compressed)) for compressed, _ in files) + deletes
+    compressed_stream, _ = handler.build_stream()
+    stream_frames = frames(len(compressed_stream)) + 1
+
+    print('{} files, {} deletes'.format(len(files), deletes))
+    print('{:<10} {:>9} {:>9}'.format('', 'bytes', 'frames'))
+    print('{:<10} {:>9} {:>9}'.format('per file', file_size, file_frames))
+    print('{:<10} {:>9} {:>9}'.format('stream', len(compressed_stream), stream_frames))
+    return 0
+
+
+def _uplinks(count, fleet, seed=0):
+    rng = random.Random(seed)
+    uplinks = []
+    for i in range(count):
+        ota = i % 10 == 0
+        dev_eui = fleet[i % len(fleet)] if ota or rng.random() < 0.5 else '{:016x}'.format(rng.getrandbits(64))
+        data = b'$OTA,4,*' if ota else bytes(rng.getrandbits(8) for _ in range(12))
+        payload = json.dumps({'deduplicationId': str(i), 'time': '2026-01-01T00:00:00Z',
+                              'deviceInfo': {'tenantId': 't', 'applicationId': 'a', 'devEui': dev_eui},
+                              'devAddr': '01020304', 'fCnt': i, 'fPort': 1,
+                              'data': base64.b64encode(data).decode(),
+                              'rxInfo': [{'gatewayId': '0016c001ff10a235', 'rssi': -60, 'snr': 9.5}],
+                              'txInfo': {'frequency': 868100000}}, separators=(',', ':'))
+        uplinks.append(('application/a/device/{}/event/up'.format(dev_eui), payload.encode()))
+    return uplinks
+
+
+def _decode_per_field(uplinks, fleet):
+    # devEUI and data each parsed out of the JSON payload, as process_rx_msg used to
+    decoded = 0
+    for _, payload in uplinks:
+        payload = payload.decode()
+        dev_eui = json.loads(payload)['deviceInfo']['devEui']
+        msg = base64.b64decode(json.loads(payload)['data'])
+        if b'$OTA' in msg and dev_eui in fleet:
+            msg.decode()
+            decoded += 1
+    return decoded
+
+
+def _decode_uplinks(uplinks, decoder):
+    decoded = 0
+    for topic, payload in uplinks:
+        if decoder.decode(topic, payload) is not None:
+            decoded += 1
+    return decoded
+
+
+def bench_uplink(args):
+    count = int(args[0]) if args else 100000
+    fleet = ['{:016x}'.format(i) for i in range(1000)]
+    uplinks = _uplinks(count, fleet)
+    fleet = frozenset(fleet)
+    decoders = [('per field', _decode_per_field, fleet),
+                ('json', _decode_uplinks, UplinkDecoder(fleet, json.loads))]
+    if orjson is not None:
+        decoders.append(('orjson', _decode_uplinks, UplinkDecoder(fleet, orjson.loads)))
+
+    print('{:<10} {:>8} {:>12}'.format('decoder', 'ota', 'uplinks/s'))
+    for name, decode, arg in decoders:
+        decoded, elapsed = _timed(decode, uplinks, arg)
+        print('{:<10} {:>8} {:>12.0f}'.format(name, decoded, count / elapsed))
+    return 0
+
+
+# shorter than the RENDEZVOUS_RETRY_DELAY and RENDEZVOUS_MAX_RETRY_DELAY defaults,
+# the benchmark runs in real time
+RENDEZVOUS_RETRY_DELAY = 2.0
+RENDEZVOUS_MAX_RETRY_DELAY = 10.0
+# seconds between an update info downlink and the reply of the device
+RENDEZVOUS_REPLY_DELAY = 0.5
+# one device every 8 seconds before the rendezvous
+SEQUENTIAL_QUERY_DELAY = 8.0
+
+
+def bench_rendezvous(args):
+    nb_devices = int(args[0]) if len(args) > 0 else 500
+    rate = float(args[1]) if len(args) > 1 else 100.0
+    loss = float(args[2]) if len(args) > 2 else 0.5
+    rnd = random.Random(0)
+    rendezvous = None
+
+    def send(dev_eui):
+        if rnd.random() >= loss:
+            timer = threading.Timer(RENDEZVOUS_REPLY_DELAY, rendezvous.reply, (dev_eui,))
+            timer.daemon = True
+            timer.start()
+
+    rendezvous = Rendezvous(['{:016x}'.format(i) for i in range(nb_devices)], send, rate,
+                            RENDEZVOUS_RETRY_DELAY, RENDEZVOUS_MAX_RETRY_DELAY, rng=random.Random(1))
+    start = time.monotonic()
+    if not rendezvous.run():
+        print('rendezvous stopped before every device replied')
+        return 1
+    elapsed = time.monotonic() - start
+    print('{} devices, {:.0f} downlinks/s, {:.0%} loss'.format(nb_devices, rate, loss))
+    print('{:<12} {:>9} {:>10}'.format('', 'downlinks', 'seconds'))
+    print('{:<12} {:>9} {:>10.1f}'.format('rendezvous', rendezvous.sent, elapsed))
+    # the same downlinks, one every 8 seconds
+    print('{:<12} {:>9} {:>10.1f}'.format('sequential', rendezvous.sent, rendezvous.sent * SEQUENTIAL_QUERY_DELAY))
+    return 0
+
+
+BENCHMARKS = {
+    'delta': bench_delta,
+    'bisect': bench_bisect,
+    'encoding': bench_encoding,
+    'zdict': bench_zdict,
+    'fec': bench_fec,
+    'stream': bench_stream,
+    'uplink': bench_uplink,
+    'rendezvous': bench_rendezvous,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__)
+        sys.exit(1)
+    sys.exit(BENCHMARKS[sys.argv[1]](sys.argv[2:]))
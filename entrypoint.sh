@@ -1,3 +1,7 @@
 #!/bin/sh
 
-python -u /updater.py
\ No newline at end of file
+# docker run <image> precompute|zdict [options], the action itself passes its inputs as arguments
+case "$1" in
+    precompute|zdict) exec python -u /updater.py "$@" ;;
+esac
+python -u /updater.py
@@ -1,18 +1,33 @@
 #!/usr/bin/env python3
-"""Github action entry point script."""
+"""Github action entry point script.
+
+Usage:
+    updater.py                  run the update campaign
+    updater.py precompute [-h]  build the patch bundles for the firmware history
+    updater.py zdict [-h]       build a preset dictionary from the firmware history
+"""
 
 import os
-import paho.mqtt.client as paho
+import sys
+import argparse
+import asyncio
 import atexit
 import threading
-from utils.ota import OTAHandler
-from utils.config import UpdaterConfig
-from utils.files import move_files
+from utils.files import move_files, workspace_items, export_history, FIRMWARE_DIR, PATCH_BUNDLE_DIR, ZDICT_DIR
+from utils.groupUpdater import precompute_bundles, BINARY_EXT
+from utils.zdict import build_zdict, save_zdict, load_zdict, zdict_id, ZDICT_MAX_SIZE
 
 
 exit = False
 client = None
-config = UpdaterConfig()
+
+# defaults of the inputs read from the workspace, relative to the new_version directory the campaign runs in
+WORKSPACE_INPUTS = {
+    'PATCH_BUNDLE_DIR': '../' + PATCH_BUNDLE_DIR,
+    'PATCH_CACHE_DIR': '../patch_cache',
+    'CAMPAIGN_STATE_FILE': '../campaign_state.json',
+    'PATCH_ZDICT_DIR': '../' + ZDICT_DIR,
+}
 
 
 def sigint_handler(signum, frame):
@@ -24,8 +39,9 @@ def exit_handler():
 
 atexit.register(exit_handler)
 
-def on_message(mosq, ota, msg):
-    ota.process_rx_msg(msg.payload.decode())
+def on_message(mosq, dispatcher, msg):
+    # runs on the network thread, the OTA handler runs on the dispatcher workers
+    dispatcher.dispatch(msg.topic, msg.payload)
 
 def on_connect(client, userdata, flags, rc):
     if rc==0:
@@ -33,10 +49,39 @@ def on_connect(client, userdata, flags, rc):
     else:
         print("Bad connection Returned code=",rc) 
 
+def start_async_updater():
+    from utils.asyncCampaign import AsyncUpdater
+    from utils.ota import config
+
+    updater = AsyncUpdater()
+    updater.add_campaign(config.DEVICE_EUI)
+    if not asyncio.run(updater.run()):
+        print("Device update did not finish successfully")
+        os._exit(1)
+    os._exit(0)
+
 def start_lora_ota_updater():
+    # the campaign modules read the action inputs on import, precompute runs without them
+    import paho.mqtt.client as paho
+    from utils.ota import OTAHandler, config
+    from utils.dispatcher import MessageDispatcher
+
+    if config.PATCH_ZDICT:
+        # the patches of every group need it, checked before any device is contacted
+        try:
+            load_zdict(config.PATCH_ZDICT_DIR, config.PATCH_ZDICT)
+        except (OSError, ValueError) as e:
+            print(f"Error loading the preset dictionary {config.PATCH_ZDICT} from {config.PATCH_ZDICT_DIR}: {e}")
+            os._exit(1)
+
+    if config.ASYNC_ORCHESTRATION:
+        start_async_updater()
+
     ota = OTAHandler()
+    dispatcher = MessageDispatcher(ota.process_rx_msg, config.MQTT_WORKERS, config.MQTT_QUEUE_SIZE,
+                                   droppable=ota.droppable_uplink)
 
-    client = paho.Client(userdata=ota)
+    client = paho.Client(userdata=dispatcher)
 
     client.on_message = on_message
     client.on_connect = on_connect
@@ -57,10 +102,63 @@ def start_lora_ota_updater():
         pass
     
     client.disconnect()
+    dispatcher.stop()
     os._exit(0)
 
+def workspace_inputs():
+    # read before the configuration, move_files() must not move them away
+    return workspace_items(os.environ.get('INPUT_' + name) or default for name, default in WORKSPACE_INPUTS.items())
+
+def precompute(argv):
+    parser = argparse.ArgumentParser(prog='updater.py precompute',
+                                     description='Build the patch bundles from older firmware versions to the latest one.')
+    parser.add_argument('--firmware-dir', default=FIRMWARE_DIR, help='firmware history directory, one sub directory per version')
+    parser.add_argument('--bundle-dir', default=PATCH_BUNDLE_DIR, help='output directory of the patch bundles')
+    parser.add_argument('--window', type=int, default=0, help='only the N most recent older versions, 0 for all of them')
+    parser.add_argument('--from-git', metavar='REPO', default=None,
+                        help='first extract to the firmware directory every src/ version of the git history of REPO')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used to generate patches')
+    parser.add_argument('--cache-dir', default=None, help='patch cache directory')
+    parser.add_argument('--cache-max-size', type=int, default=64 * 1024 * 1024, help='maximum size in bytes of the patch cache')
+    parser.add_argument('--diff-budget', type=int, default=2000000, help='edit graph steps per file diff, 0 for the 1s wall-clock timeout')
+    parser.add_argument('--optimize', action='store_true', help='try several diff strategies per file and keep the smallest patch')
+    parser.add_argument('--encoding', choices=['text', 'binary'], default='text', help='patch serialisation sent to the devices')
+    parser.add_argument('--zdict', default='', help='id of the preset dictionary used to compress the text patches')
+    parser.add_argument('--zdict-dir', default=ZDICT_DIR, help='directory of the preset dictionaries')
+    parser.add_argument('--patience-ext', nargs='*', default=['.py'], help='file extensions diffed with the patience line diff')
+    args = parser.parse_args(argv)
+
+    if args.from_git is not None:
+        print("{} versions extracted from the git history".format(export_history(args.firmware_dir, args.from_git)))
+    paths = precompute_bundles(args.firmware_dir, args.bundle_dir, args.window,
+                               cache_dir=args.cache_dir, cache_max_size=args.cache_max_size,
+                               patch_workers=args.workers, patience_ext=args.patience_ext,
+                               diff_budget=args.diff_budget, optimize=args.optimize,
+                               patch_encoding=args.encoding, zdict_dir=args.zdict_dir, zdict=args.zdict)
+    for path in paths:
+        print("Patch bundle written to {}".format(path))
+    return 0
+
+def zdict(argv):
+    parser = argparse.ArgumentParser(prog='updater.py zdict',
+                                     description='Build a preset dictionary for the patch compression from the firmware history.')
+    parser.add_argument('--firmware-dir', default=FIRMWARE_DIR, help='firmware history directory, one sub directory per version')
+    parser.add_argument('--zdict-dir', default=ZDICT_DIR, help='output directory of the dictionary')
+    parser.add_argument('--encoding', choices=['text', 'binary'], default='text', help='patch serialisation the dictionary is built for')
+    parser.add_argument('--max-size', type=int, default=ZDICT_MAX_SIZE, help='maximum size in bytes of the dictionary')
+    args = parser.parse_args(argv)
+
+    zdict = build_zdict(args.firmware_dir, args.encoding, BINARY_EXT, args.max_size)
+    path = save_zdict(args.zdict_dir, zdict)
+    print("Dictionary {} ({} bytes) written to {}".format(zdict_id(zdict), len(zdict), path))
+    return 0
+
 if __name__ == '__main__':
-    move_files()
+    if len(sys.argv) > 1 and sys.argv[1] == 'precompute':
+        sys.exit(precompute(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'zdict':
+        sys.exit(zdict(sys.argv[2:]))
+    move_files(workspace_inputs())
     try:
         start_lora_ota_updater()
     except KeyboardInterrupt:
@@ -24,6 +24,7 @@
 import urllib.request
 import binascii
 import base64
+import copy
 import os
 import json
 from .config import UpdaterConfig
@@ -78,17 +79,19 @@ class LoraServerClient:
 
         url = self.server + ':' + str(self.port) + '/api/multicast-groups'
 
-        mcGroup_payload["multicastGroup"]["applicationId"] = app_id
-        mcGroup_payload["multicastGroup"]["dr"] = dr
-        mcGroup_payload["multicastGroup"]["frequency"] = freq
-        mcGroup_payload["multicastGroup"]["id"] = group_id.decode("utf-8")
-        mcGroup_payload["multicastGroup"]["mcAddr"] = mcAddr.decode("utf-8")
-        mcGroup_payload["multicastGroup"]["mcAppSKey"] = mcAppSKey.decode("utf-8")
-        mcGroup_payload["multicastGroup"]["mcNwkSKey"] = mcNwkSKey.decode("utf-8")
-        mcGroup_payload["multicastGroup"]["name"] = group_name
+        # the groups of a campaign are created and fed from several threads, the templates stay untouched
+        group_payload = copy.deepcopy(mcGroup_payload)
+        group_payload["multicastGroup"]["applicationId"] = app_id
+        group_payload["multicastGroup"]["dr"] = dr
+        group_payload["multicastGroup"]["frequency"] = freq
+        group_payload["multicastGroup"]["id"] = group_id.decode("utf-8")
+        group_payload["multicastGroup"]["mcAddr"] = mcAddr.decode("utf-8")
+        group_payload["multicastGroup"]["mcAppSKey"] = mcAppSKey.decode("utf-8")
+        group_payload["multicastGroup"]["mcNwkSKey"] = mcNwkSKey.decode("utf-8")
+        group_payload["multicastGroup"]["name"] = group_name
         # default region is EU868
 
-        payload = bytes(json.dumps(mcGroup_payload), 'utf-8')
+        payload = bytes(json.dumps(group_payload), 'utf-8')
 
         try:
             r = urllib.request.Request(url, data=payload, method='POST')
@@ -128,9 +131,9 @@ class LoraServerClient:
 
         url = self.server + ':' + str(self.port) + '/api/multicast-groups/' + group_id + '/devices'
 
-        mcAddDevice_payload["devEui"] = devEUI
+        device_payload = dict(mcAddDevice_payload, devEui=devEUI)
 
-        payload = json.dumps(mcAddDevice_payload).encode('utf-8')
+        payload = json.dumps(device_payload).encode('utf-8')
 
         try:
             r = urllib.request.Request(url, data=payload, method='POST')
@@ -188,9 +191,7 @@ class LoraServerClient:
             with urllib.request.urlopen(r) as f:
                 resp = f.read().decode('utf-8')
                 if "multicastQueueItems" in resp:
-                    print(resp)
                     json_resp = json.loads(resp)["multicastQueueItems"]
-                    print("Len: {}".format(len(json_resp)))
                     return len(json_resp)
                 else:
                     return -1
@@ -201,11 +202,12 @@ class LoraServerClient:
         return -1
 
     def send(self, api_key, multicast_group, data):
-        url = self.server + ':' + str(self.port) + '/api/multcast-groups/' + multicast_group + '/queue'
+        url = self.server + ':' + str(self.port) + '/api/multicast-groups/' + multicast_group + '/queue'
 
-        mcQueue_payload["queueItem"]["data"] = base64.b64encode(data).decode("utf-8")
+        queue_payload = copy.deepcopy(mcQueue_payload)
+        queue_payload["queueItem"]["data"] = base64.b64encode(data).decode("utf-8")
 
-        payload = bytes(json.dumps(mcQueue_payload), 'utf-8')
+        payload = bytes(json.dumps(queue_payload), 'utf-8')
 
         try:
             r = urllib.request.Request(url, data=payload, method='POST')
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# Time-on-air of the downlinks and duty-cycle aware pacing.
+#
+# time_on_air() follows the Semtech SX1276 datasheet (LoRa) and the LoRaWAN
+# regional parameters (FSK). TxScheduler releases every frame as soon as the
+# previous one is over the air and the sub-band duty cycle, measured over any
+# sliding window of DUTY_CYCLE_WINDOW seconds, still has room for it.
+# Channels in different sub-bands have their own duty cycle budget but share
+# the transmitter of the gateway, see channel_schedulers().
+
+from .regions import FSK, datarate, duty_cycle, duty_cycle_band
+from collections import deque
+import math
+import threading
+import time
+
+
+# MHDR, FHDR without FOpts, FPort and MIC around the application payload
+LORAWAN_OVERHEAD = 13
+LORA_PREAMBLE_SYMBOLS = 8
+# 4/5
+LORA_CODING_RATE = 1
+# ETSI EN 300 220 observation period
+DUTY_CYCLE_WINDOW = 3600.0
+
+
+def time_on_air(phy_length, modulation, coding_rate=LORA_CODING_RATE, crc=False):
+    """Seconds on air of a PHY payload of phy_length bytes, downlinks have no payload CRC."""
+    sf, bw = modulation
+    if sf == FSK:
+        # preamble (5), sync word (3), length (1), payload and CRC (2)
+        return (5 + 3 + 1 + phy_length + 2) * 8.0 / bw
+
+    t_sym = float(2 ** sf) / bw
+    # low data rate optimisation above 16 ms symbols
+    de = 1 if t_sym > 0.016 else 0
+    payload_bits = 8 * phy_length - 4 * sf + 28 + (16 if crc else 0)
+    payload_symbols = 8 + max(math.ceil(payload_bits / (4.0 * (sf - 2 * de))) * (coding_rate + 4), 0)
+    return (LORA_PREAMBLE_SYMBOLS + 4.25 + payload_symbols) * t_sym
+
+
+class Radio:
+    """Transmitter shared by the schedulers, one frame on the air at a time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.busy_until = 0.0
+
+
+class TxScheduler:
+    """Paces the frames of one downlink sub-band."""
+
+    def __init__(self, region, dr, frequency, window=DUTY_CYCLE_WINDOW, radio=None):
+        self._modulation = datarate(region, dr)
+        self.duty_cycle = duty_cycle(region, frequency)
+        self._window = window
+        # (start, end) of the frames still in the window
+        self._frames = deque()
+        self._radio = radio if radio is not None else Radio()
+        self.total_airtime = 0.0
+
+    def airtime(self, length):
+        """Time-on-air of an application payload of length bytes."""
+        return time_on_air(length + LORAWAN_OVERHEAD, self._modulation)
+
+    def _earliest_start(self, now, airtime):
+        start = max(now, self._radio.busy_until)
+        if self.duty_cycle is None:
+            return start
+
+        budget = self.duty_cycle * self._window
+        if airtime > budget:
+            raise ValueError("A {:.3f} s frame exceeds the duty cycle budget".format(airtime))
+        # airtime already used in the window ending with the new frame
+        window_start = start + airtime - self._window
+        used = sum(end - max(begin, window_start) for begin, end in self._frames if end > window_start)
+        excess = used + airtime - budget
+        if excess <= 0:
+            return start
+
+        # slide the window until enough of the oldest frames left it
+        for begin, end in self._frames:
+            if end <= window_start:
+                continue
+            begin = max(begin, window_start)
+            if end - begin < excess:
+                excess -= end - begin
+                continue
+            window_start = begin + excess
+            break
+        return window_start + self._window - airtime
+
+    def reserve(self, length):
+        """Book the earliest slot for a payload of length bytes and return its start time."""
+        airtime = self.airtime(length)
+        with self._radio.lock:
+            now = time.monotonic()
+            while self._frames and self._frames[0][1] <= now - self._window:
+                self._frames.popleft()
+            start = self._earliest_start(now, airtime)
+            self._frames.append((start, start + airtime))
+            self._radio.busy_until = start + airtime
+            self.total_airtime += airtime
+        return start
+
+    def wait(self, length):
+        """Block until a payload of length bytes can be sent."""
+        delay = self.reserve(length) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def channel_schedulers(region, dr, frequencies):
+    """Map every frequency to its scheduler, the frequencies of a sub-band share its duty cycle budget."""
+    radio = Radio()
+    band_schedulers = dict()
+    schedulers = dict()
+    for frequency in frequencies:
+        band = duty_cycle_band(region, frequency)
+        if band not in band_schedulers:
+            band_schedulers[band] = TxScheduler(region, dr, frequency, radio=radio)
+        schedulers[frequency] = band_schedulers[band]
+    return schedulers
@@ -0,0 +1,577 @@
+#!/usr/bin/env python
+#
+# asyncio implementation of the update campaign.
+#
+# A single event loop runs any number of campaigns over one MQTT connection:
+# the LoRa server API is called over asyncio streams, the paho client is driven
+# by the loop through its socket callbacks, and every wait (device replies,
+# duty cycle pacing, queue polling) is a coroutine instead of a sleeping
+# thread. A campaign goes through the phases of OTAHandler: rendezvous,
+# multicast group setup, key distribution, transmission with the optional
+# repair rounds, and verification of the device versions. The patches are
+# built in the default executor, the only threads besides the loop.
+#
+# The progress of the campaigns is not saved, CAMPAIGN_STATE_FILE only applies
+# to OTAHandler.
+
+from .LoraServer import mcGroup_payload, mcQueue_payload, mcAddDevice_payload
+from .ota import OTAProtocol, parse_missing_fragments, config
+from .groupUpdater import updateHandler
+from .airtime import channel_schedulers
+from .regions import max_payload
+from .rendezvous import RateLimiter, RETRY_JITTER
+from .delivery import AUTO, UNICAST
+from .uplink import UplinkDecoder
+from distutils.version import LooseVersion
+import paho.mqtt.client as paho
+import urllib.parse
+import binascii
+import asyncio
+import base64
+import socket
+import random
+import copy
+import json
+import time
+import uuid
+import os
+
+
+def _handler_settings():
+    # updateHandler settings of the action inputs, the campaign sends the frames itself
+    return dict(cache_dir=config.PATCH_CACHE_DIR, cache_max_size=config.PATCH_CACHE_MAX_SIZE,
+                patch_workers=config.PATCH_WORKERS, bundle_dir=config.PATCH_BUNDLE_DIR,
+                patience_ext=config.PATCH_PATIENCE_EXT, diff_budget=config.PATCH_DIFF_BUDGET,
+                optimize=config.PATCH_OPTIMIZE, patch_encoding=config.PATCH_ENCODING,
+                zdict_dir=config.PATCH_ZDICT_DIR, zdict=config.PATCH_ZDICT,
+                fec_redundancy=config.PATCH_FEC_REDUNDANCY, repair_rounds=config.PATCH_REPAIR_ROUNDS,
+                stream=config.PATCH_STREAM)
+
+
+async def _wait_events(events, timeout):
+    """True if every event is set within timeout seconds."""
+    try:
+        await asyncio.wait_for(asyncio.gather(*(event.wait() for event in events)), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+class AsyncLoraServerClient:
+    """The requests of LoraServerClient over asyncio streams, one HTTP/1.0 request per connection."""
+
+    def __init__(self, url, port, api_key):
+        parts = urllib.parse.urlsplit(url if '://' in url else 'http://' + url)
+        self._host = parts.hostname
+        self._port = port
+        self._ssl = parts.scheme == 'https'
+        self._api_key = api_key
+
+    async def _request(self, method, path, payload=None):
+        body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        head = ['{} {} HTTP/1.0'.format(method, path),
+                'Host: {}:{}'.format(self._host, self._port),
+                'Accept: application/json',
+                'Grpc-Metadata-Authorization: Bearer ' + self._api_key,
+                'Content-Length: {}'.format(len(body))]
+        if payload is not None:
+            head.append('Content-Type: application/json')
+        reader, writer = await asyncio.open_connection(self._host, self._port, ssl=True if self._ssl else None)
+        try:
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('utf-8') + body)
+            await writer.drain()
+            # HTTP/1.0, the server closes the connection after the response
+            response = await reader.read()
+        finally:
+            writer.close()
+        status_line, _, content = response.partition(b'\r\n\r\n')
+        return int(status_line.split(b' ', 2)[1]), content.decode('utf-8')
+
+    async def create_multicast_group(self, dr, freq, group_name, app_id):
+        mcAddr = binascii.hexlify(os.urandom(4))
+        mcAppSKey = binascii.hexlify(os.urandom(16))
+        mcNwkSKey = binascii.hexlify(os.urandom(16))
+        payload = copy.deepcopy(mcGroup_payload)
+        payload["multicastGroup"].update({
+            "applicationId": app_id,
+            "dr": dr,
+            "frequency": freq,
+            "id": str(uuid.uuid4()),
+            "mcAddr": mcAddr.decode("utf-8"),
+            "mcAppSKey": mcAppSKey.decode("utf-8"),
+            "mcNwkSKey": mcNwkSKey.decode("utf-8"),
+            "name": group_name,
+        })
+        try:
+            _, resp = await self._request('POST', '/api/multicast-groups', payload)
+            if '"id":' in resp:
+                return (json.loads(resp)["id"], mcAddr, mcNwkSKey, mcAppSKey)
+        except (OSError, ValueError) as ex:
+            print("Error creating multicast data: {}".format(ex))
+        return None
+
+    async def delete_multicast_group(self, group_id):
+        try:
+            status, _ = await self._request('DELETE', '/api/multicast-groups/' + group_id)
+            return status == 200
+        except (OSError, ValueError) as ex:
+            print("Error deleting multicast group: {}".format(ex))
+        return False
+
+    async def add_device_multicast_group(self, devEUI, group_id):
+        payload = dict(mcAddDevice_payload, devEui=devEUI)
+        try:
+            status, _ = await self._request('POST', '/api/multicast-groups/' + group_id + '/devices', payload)
+            return status == 200
+        except (OSError, ValueError) as ex:
+            print("Error adding device to multicast group: {}".format(ex))
+        return False
+
+    async def multicast_queue_length(self, multicast_group):
+        try:
+            _, resp = await self._request('GET', '/api/multicast-groups/' + multicast_group + '/queue')
+            if "multicastQueueItems" in resp:
+                return len(json.loads(resp)["multicastQueueItems"])
+        except (OSError, ValueError) as ex:
+            print("Error getting multicast queue length: {}".format(ex))
+        return -1
+
+    async def send(self, multicast_group, data):
+        payload = copy.deepcopy(mcQueue_payload)
+        payload["queueItem"]["data"] = base64.b64encode(data).decode("utf-8")
+        try:
+            status, _ = await self._request('POST', '/api/multicast-groups/' + multicast_group + '/queue', payload)
+            return status == 200
+        except (OSError, ValueError) as ex:
+            print("Error sending multicast data: {}".format(ex))
+        return False
+
+
+class AsyncMqttClient:
+    """paho client driven by the event loop through its socket callbacks."""
+
+    def __init__(self, on_message):
+        self._loop = asyncio.get_running_loop()
+        self._connected = self._loop.create_future()
+        self._misc_task = None
+        self._client = paho.Client()
+        self._client.on_connect = self._on_connect
+        self._client.on_message = lambda client, userdata, msg: on_message(msg.topic, msg.payload)
+        self._client.on_socket_open = self._on_socket_open
+        self._client.on_socket_close = self._on_socket_close
+        self._client.on_socket_register_write = self._on_socket_register_write
+        self._client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if self._connected.done():
+            return
+        if rc == 0:
+            client.subscribe("application/+/device/+/event/up", 0)
+            self._connected.set_result(True)
+        else:
+            self._connected.set_exception(ConnectionError("Bad connection Returned code={}".format(rc)))
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._loop.add_reader(sock, client.loop_read)
+        self._misc_task = self._loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._loop.remove_reader(sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        # keepalives and retries
+        while self._client.loop_misc() == paho.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def connect(self, host, port, keepalive=60):
+        self._client.connect(host, port, keepalive)
+        self._client.socket().setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2048)
+        await self._connected
+
+    def publish(self, topic, payload):
+        self._client.publish(topic=topic, payload=payload)
+
+    async def disconnect(self):
+        self._client.disconnect()
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+
+
+class AsyncRateLimiter:
+    """RateLimiter shared by coroutines."""
+
+    def __init__(self, rate):
+        self._limiter = RateLimiter(rate)
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            delay = self._limiter.delay()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self._limiter.delay()
+            self._limiter.take()
+
+
+class _Device:
+
+    def __init__(self):
+        self.version = None
+        self.replied = asyncio.Event()
+        self.listening = asyncio.Event()
+        # missing fragment indexes by session, reported during a repair round
+        self.missing = dict()
+        self.repair_complete = False
+        self.repair_reply = asyncio.Event()
+        self.final_version = None
+        self.reported = asyncio.Event()
+
+
+class AsyncCampaign(OTAProtocol):
+
+    # seconds given to the devices to report their version after the transfer
+    VERIFY_TIMEOUT = 300
+    # seconds given to the rendezvous and to the key distribution, as the watchdog of OTAHandler
+    PHASE_TIMEOUT = 300
+
+    def __init__(self, devices, client, mqtt, tx_schedulers, limiter, firmware_dir='../firmware'):
+        self.firmware_dir = firmware_dir
+        self._latest_version = '0.0.0'
+        self._clientApp = client
+        self._mqtt = mqtt
+        self._loraserver_app_id = config.LORASERVER_APP_ID
+        self._downlink_datarate = config.LORASERVER_DOWNLINK_DR
+        self._downlink_freqs = config.LORASERVER_DOWNLINK_FREQS or [config.LORASERVER_DOWNLINK_FREQ]
+        # shared by the campaigns, they use the same gateways
+        self._tx_schedulers = tx_schedulers
+        self.tx_scheduler = tx_schedulers[self._downlink_freqs[0]]
+        self._limiter = limiter
+        self.max_payload = max_payload(config.LORASERVER_REGION, self._downlink_datarate, config.LORASERVER_DWELL_TIME)
+        self._delivery_mode = config.DELIVERY_MODE
+        self._queue_low_watermark = config.LORASERVER_QUEUE_LOW_WATERMARK
+        self._queue_high_watermark = config.LORASERVER_QUEUE_HIGH_WATERMARK
+        self._repair_rounds = config.PATCH_REPAIR_ROUNDS
+        self._devices = dict((dev_eui, _Device()) for dev_eui in devices)
+        # devices to update, the up to date ones are left out after the rendezvous
+        self._targets = []
+        # devices left out of the update: silent, or of a version without firmware to build the patches from
+        self._not_updated = []
+        # id, keys, frequency, devices, handler and transfer frames of every multicast group
+        self._groups = []
+        self._version_handlers = dict()
+
+    @property
+    def devices(self):
+        return list(self._devices)
+
+    def _check_version(self):
+        latest = '0.0.0'
+        for d in os.listdir(self.firmware_dir):
+            if not os.path.isdir(os.path.join(self.firmware_dir, d)):
+                continue
+            if LooseVersion(latest) < LooseVersion(d):
+                latest = d
+        return latest
+
+    def _send_payload(self, dev_eui, data):
+        topic, payload = self._downlink(dev_eui, data)
+        self._mqtt.publish(topic, payload)
+
+    async def _paced(self, scheduler, length):
+        delay = scheduler.reserve(length) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def process_uplink(self, dev_eui, msg):
+        device = self._devices.get(dev_eui)
+        if device is None:
+            return
+        msg_type = self.get_msg_type(msg)
+        if msg_type in (self.UPDATE_INFO_REPLY, self.DEVICE_VERSION_MSG) and self.get_msg_version(msg) is None:
+            print(f"Invalid message from {dev_eui}: {msg}")
+            return
+        if msg_type == self.UPDATE_INFO_REPLY:
+            device.version = self.get_msg_version(msg)
+            device.replied.set()
+        elif msg_type == self.LISTENING_MSG:
+            device.listening.set()
+        elif msg_type == self.MISSING_FRAGMENTS_MSG:
+            try:
+                missing = parse_missing_fragments(msg)
+            except ValueError:
+                print(f"Invalid missing fragments message from {dev_eui}: {msg}")
+                return
+            # a device may split its report over several messages
+            for session, indexes in missing.items():
+                device.missing.setdefault(session, set()).update(indexes)
+            device.repair_reply.set()
+        elif msg_type == self.FRAGMENTS_COMPLETE_MSG:
+            device.repair_complete = True
+            device.repair_reply.set()
+        elif msg_type == self.DEVICE_VERSION_MSG:
+            device.final_version = self.get_msg_version(msg)
+            device.reported.set()
+
+    async def run(self):
+        """Update the devices, True if all of them end up with the latest version."""
+        self._latest_version = self._check_version()
+        print(f"Latest version Available: {self._latest_version}")
+        await self._rendezvous()
+
+        devices_versions = dict()
+        for dev_eui, device in self._devices.items():
+            if device.version is None:
+                self._not_updated.append(dev_eui)
+                continue
+            if LooseVersion(device.version) == LooseVersion(self._latest_version):
+                print(f"Device {dev_eui} is up to date to latest version.")
+                continue
+            devices_versions.setdefault(device.version, []).append(dev_eui)
+        for version in list(devices_versions):
+            if not await asyncio.to_thread(self._has_source_tree, version):
+                print(f"No firmware {version} to build the patches from, "
+                      f"its {len(devices_versions[version])} devices are not updated")
+                self._not_updated.extend(devices_versions.pop(version))
+        self._targets = [dev_eui for devices in devices_versions.values() for dev_eui in devices]
+        if not self._targets:
+            return not self._not_updated
+
+        try:
+            await self._setup_groups(devices_versions)
+            try:
+                await asyncio.wait_for(self._distribute_keys(), self.PHASE_TIMEOUT)
+            except asyncio.TimeoutError:
+                await self._drop_silent_devices()
+            await asyncio.sleep(self.UPDATE_START_DELAY)
+            print("Devices are ready, starting update process...")
+            await asyncio.gather(*(self._transmit(group) for group in self._groups))
+        finally:
+            for group in self._groups:
+                if not group['unicast'] and not group['deleted']:
+                    await self._clientApp.delete_multicast_group(group['id'])
+        return await self._verify()
+
+    async def _rendezvous(self):
+        print("sending update info to devices...")
+        try:
+            await asyncio.wait_for(asyncio.gather(*(self._query(dev_eui) for dev_eui in self._devices)),
+                                   self.PHASE_TIMEOUT)
+        except asyncio.TimeoutError:
+            silent = [dev_eui for dev_eui, device in self._devices.items() if not device.replied.is_set()]
+            print(f"No update info reply within {self.PHASE_TIMEOUT} s from {silent}, they are not updated")
+
+    async def _query(self, dev_eui):
+        device = self._devices[dev_eui]
+        delay = config.RENDEZVOUS_RETRY_DELAY
+        while not device.replied.is_set():
+            await self._limiter.acquire()
+            self._send_payload(dev_eui, self._create_update_info_msg())
+            if await _wait_events([device.replied], delay * (1 + random.uniform(-RETRY_JITTER, RETRY_JITTER))):
+                break
+            delay = min(delay * 2, config.RENDEZVOUS_MAX_RETRY_DELAY)
+        print(f"Device {dev_eui} version: {device.version}")
+
+    async def _version_patches(self, version):
+        if version not in self._version_handlers:
+            handler = updateHandler(version, self._latest_version, None, None, None, self, **_handler_settings())
+            await asyncio.to_thread(handler.prepare_patches)
+            self._version_handlers[version] = handler
+        return self._version_handlers[version]
+
+    async def _setup_groups(self, devices_versions):
+        # one sub-campaign per source version, the versions with identical patches share one
+        partitions = dict()
+        for version in sorted(devices_versions, key=LooseVersion):
+            transfer_hash = (await self._version_patches(version)).transfer_hash()
+            versions, devices = partitions.setdefault(transfer_hash, ([], []))
+            versions.append(version)
+            devices.extend(devices_versions[version])
+
+        nb_partitions = len(partitions)
+        for versions, devices in partitions.values():
+            handler = self._version_handlers[versions[0]]
+            delivery = self._delivery_mode
+            if delivery == AUTO:
+                frame_lengths = await asyncio.to_thread(handler.frame_lengths)
+                delivery = self._cheaper_delivery(versions[0], devices, frame_lengths)
+            # the groups of a partition send the same frames
+            transfer = await asyncio.to_thread(handler.transfer_frames)
+            if delivery == UNICAST:
+                for dev_eui in devices:
+                    self._add_group(dev_eui, None, self._downlink_freqs[0], [dev_eui], handler, transfer)
+                continue
+            nb_groups = min(len(self._downlink_freqs), len(devices))
+            for index, frequency in enumerate(self._downlink_freqs[:nb_groups]):
+                print(f"Creating multicast group for {', '.join(versions)} on {frequency} Hz...")
+                group_name = versions[0].strip() + '-' + self._latest_version.strip()
+                if nb_partitions > 1 or nb_groups > 1:
+                    group_name += '-' + str(len(self._groups))
+                keys = await self._clientApp.create_multicast_group(self._downlink_datarate, frequency, group_name,
+                                                                    self._loraserver_app_id)
+                if keys is None:
+                    raise RuntimeError("Error creating multicast group " + group_name)
+                group = self._add_group(keys[0], keys, frequency, devices[index::nb_groups], handler, transfer)
+                await asyncio.gather(*(self._clientApp.add_device_multicast_group(dev_eui, group['id'])
+                                       for dev_eui in group['devices']))
+
+    def _add_group(self, group_id, keys, frequency, devices, handler, transfer):
+        group = {'id': group_id, 'keys': keys, 'frequency': frequency, 'devices': devices,
+                 'unicast': keys is None, 'handler': handler, 'transfer': transfer,
+                 'depth': 0, 'airtime': 0.0, 'deleted': False}
+        self._groups.append(group)
+        return group
+
+    async def _distribute_keys(self):
+        multicast_groups = [group for group in self._groups if not group['unicast']]
+        pending = [(group, dev_eui) for group in multicast_groups for dev_eui in group['devices']]
+        if pending:
+            print("Sending multicast keys to devices...")
+        while pending:
+            for group, dev_eui in pending:
+                msg = self._create_multicast_keys_msg(group['keys'], group['frequency'] if len(multicast_groups) > 1 else None)
+                # class A downlink, paced as if it used the multicast channel like RX2 does
+                await self._paced(self._tx_schedulers[group['frequency']], len(msg))
+                self._send_payload(dev_eui, msg)
+            await _wait_events([self._devices[dev_eui].listening for _, dev_eui in pending], self.KEYS_REPLY_TIMEOUT)
+            pending = [(group, dev_eui) for group, dev_eui in pending if not self._devices[dev_eui].listening.is_set()]
+
+    async def _drop_silent_devices(self):
+        # the transfer goes on without the devices that never got their keys
+        silent = set(dev_eui for group in self._groups if not group['unicast'] for dev_eui in group['devices']
+                     if not self._devices[dev_eui].listening.is_set())
+        print(f"No listening reply within {self.PHASE_TIMEOUT} s from {sorted(silent)}, they are not updated")
+        self._targets = [dev_eui for dev_eui in self._targets if dev_eui not in silent]
+        self._not_updated.extend(sorted(silent))
+        for group in list(self._groups):
+            group['devices'] = [dev_eui for dev_eui in group['devices'] if dev_eui not in silent]
+            if not group['devices']:
+                await self._clientApp.delete_multicast_group(group['id'])
+                self._groups.remove(group)
+
+    async def _send_frames(self, group, frames):
+        scheduler = self._tx_schedulers[group['frequency']]
+        for msg in frames:
+            if group['unicast']:
+                await self._paced(scheduler, len(msg))
+                self._send_payload(group['devices'][0], msg)
+            elif self._queue_high_watermark > 0:
+                # only accounts the airtime, the network server sends the frames back to back
+                scheduler.reserve(len(msg))
+                if group['depth'] >= self._queue_high_watermark:
+                    group['depth'] = max(await self._clientApp.multicast_queue_length(group['id']), 0)
+                    while group['depth'] > self._queue_low_watermark:
+                        await asyncio.sleep(0.5)
+                        group['depth'] = max(await self._clientApp.multicast_queue_length(group['id']), 0)
+                await self._clientApp.send(group['id'], msg)
+                group['depth'] += 1
+            else:
+                await self._paced(scheduler, len(msg))
+                await self._clientApp.send(group['id'], msg)
+            group['airtime'] += scheduler.airtime(len(msg))
+
+    async def _drain(self, group):
+        if group['unicast']:
+            return
+        while await self._clientApp.multicast_queue_length(group['id']) > 0:
+            await asyncio.sleep(1)
+        group['depth'] = 0
+
+    async def _transmit(self, group):
+        handler = group['handler']
+        await self._send_frames(group, group['transfer'])
+        if self._repair_rounds > 0:
+            await self._repair(group, handler)
+        await self._send_frames(group, handler.closing_frames())
+        print("Estimated airtime of {}: {:.1f} s".format(group['id'], group['airtime']))
+        await self._drain(group)
+        if not group['unicast']:
+            print("deleting multicast group...")
+            await self._clientApp.delete_multicast_group(group['id'])
+            group['deleted'] = True
+
+    async def _repair(self, group, handler):
+        devices = [self._devices[dev_eui] for dev_eui in group['devices']]
+        for repair_round in range(1, self._repair_rounds + 1):
+            for device in devices:
+                device.missing = dict()
+                device.repair_complete = False
+                device.repair_reply.clear()
+            await self._send_frames(group, handler.repair_request_frames(repair_round))
+            # the reply timeout starts once the request is on the air
+            await self._drain(group)
+            await _wait_events([device.repair_reply for device in devices], self.REPAIR_REPLY_TIMEOUT)
+            if all(device.repair_complete for device in devices):
+                print("Every device received all the fragments")
+                return True
+            missing = dict()
+            for device in devices:
+                for session, indexes in device.missing.items():
+                    missing.setdefault(session, set()).update(indexes)
+            print("Repair round {}: {} missing fragments in {} patches".format(
+                repair_round, sum(len(m) for m in missing.values()), len(missing)))
+            await self._send_frames(group, handler.repair_frames(missing))
+        print("Fragments still missing after {} repair rounds".format(self._repair_rounds))
+        return False
+
+    async def _verify(self):
+        await _wait_events([self._devices[dev_eui].reported for dev_eui in self._targets], self.VERIFY_TIMEOUT)
+        failed = [dev_eui for dev_eui in self._targets if self._devices[dev_eui].final_version != self._latest_version]
+        failed += self._not_updated
+        if len(failed) == 0:
+            print(f"Devices updated succesfully to latest version: {self._latest_version}")
+        elif len(failed) == len(self._targets) + len(self._not_updated):
+            print(f"All devices failed to update to latest version: {self._latest_version}")
+        else:
+            print(f"The following devices failed to update to latest version: {failed}")
+        return len(failed) == 0
+
+
+class AsyncUpdater(OTAProtocol):
+    """Runs campaigns concurrently on one MQTT connection and one LoRa server client."""
+
+    def __init__(self):
+        self._campaigns = []
+        # device EUI -> campaign index, for the uplinks
+        self._device_campaigns = dict()
+        self._uplink_decoder = UplinkDecoder(self._device_campaigns)
+        self._running = []
+
+    def add_campaign(self, devices, firmware_dir='../firmware'):
+        for dev_eui in devices:
+            if dev_eui in self._device_campaigns:
+                raise ValueError("Device {} is already part of a campaign".format(dev_eui))
+        self._campaigns.append((list(devices), firmware_dir))
+        for dev_eui in devices:
+            self._device_campaigns[dev_eui] = len(self._campaigns) - 1
+
+    def _on_message(self, topic, payload):
+        uplink = self._uplink_decoder.decode(topic, payload)
+        if uplink is not None:
+            dev_eui, dev_msg = uplink
+            self._running[self._device_campaigns[dev_eui]].process_uplink(dev_eui, dev_msg)
+
+    async def run(self):
+        """Run every campaign, True if all of them succeeded."""
+        client = AsyncLoraServerClient(config.LORASERVER_URL, config.LORASERVER_API_PORT, config.LORASERVER_API_KEY)
+        mqtt = AsyncMqttClient(self._on_message)
+        downlink_freqs = config.LORASERVER_DOWNLINK_FREQS or [config.LORASERVER_DOWNLINK_FREQ]
+        tx_schedulers = channel_schedulers(config.LORASERVER_REGION, config.LORASERVER_DOWNLINK_DR, downlink_freqs)
+        limiter = AsyncRateLimiter(config.RENDEZVOUS_RATE)
+        self._running = [AsyncCampaign(devices, client, mqtt, tx_schedulers, limiter, firmware_dir)
+                         for devices, firmware_dir in self._campaigns]
+        await mqtt.connect(config.LORASERVER_IP, config.LORASERVER_MQTT_PORT)
+        print("Lora OTA updater started")
+        try:
+            results = await asyncio.gather(*(campaign.run() for campaign in self._running), return_exceptions=True)
+        finally:
+            await mqtt.disconnect()
+        for campaign, result in zip(self._running, results):
+            if isinstance(result, Exception):
+                print(f"Campaign of {campaign.devices} failed: {result}")
+        return all(result is True for result in results)
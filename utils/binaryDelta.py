@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# Binary delta encoding for firmware files that can not be diffed as text
+# (.mpy, .bin, images...).
+#
+# The target file is scanned with an rsync style rolling checksum against an
+# index of fixed size blocks of the source file. Matching regions are emitted
+# as COPY operations referencing the source and everything else as INSERT
+# operations carrying the raw bytes.
+#
+# Delta format:
+#   MAGIC | varint(target length) | op*
+#   INSERT: varint(length << 1)     | raw bytes
+#   COPY:   varint(length << 1 | 1) | zigzag varint(offset - end of previous copy)
+#
+# apply_delta() is the reference decoder for the device side and only uses
+# operations available in MicroPython.
+
+MAGIC = b'BD1'
+DEFAULT_BLOCK_SIZE = 16
+
+# Maximum number of source offsets kept and checked for a single weak hash,
+# bounds the work on highly repetitive data (padding, zero filled regions).
+_MAX_CANDIDATES = 8
+
+
+def encode_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _zigzag(value):
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def _weak_hash(data, start, block_size):
+    a = 0
+    b = 0
+    for i in range(block_size):
+        x = data[start + i]
+        a += x
+        b += (block_size - i) * x
+    return a & 0xffff, b & 0xffff
+
+
+def _index_blocks(source, block_size):
+    index = dict()
+    for off in range(0, len(source) - block_size + 1, block_size):
+        a, b = _weak_hash(source, off, block_size)
+        offsets = index.setdefault((b << 16) | a, [])
+        if len(offsets) < _MAX_CANDIDATES:
+            offsets.append(off)
+    return index
+
+
+def _match_length(source, s, target, t):
+    """Length of the common run of source[s:] and target[t:]."""
+    length = 0
+    limit = min(len(source) - s, len(target) - t)
+    step = 64
+    while length + step <= limit and source[s + length:s + length + step] == target[t + length:t + length + step]:
+        length += step
+    while length < limit and source[s + length] == target[t + length]:
+        length += 1
+    return length
+
+
+class _DeltaWriter:
+
+    def __init__(self, target_length):
+        self.out = bytearray(MAGIC)
+        encode_varint(self.out, target_length)
+        self._last_copy_end = 0
+
+    def insert(self, data):
+        if not data:
+            return
+        encode_varint(self.out, len(data) << 1)
+        self.out.extend(data)
+
+    def copy(self, offset, length):
+        encode_varint(self.out, (length << 1) | 1)
+        encode_varint(self.out, _zigzag(offset - self._last_copy_end))
+        self._last_copy_end = offset + length
+
+
+def make_delta(source, target, block_size=DEFAULT_BLOCK_SIZE):
+    """Return the delta that turns the bytes source into the bytes target."""
+    writer = _DeltaWriter(len(target))
+    n = len(target)
+    index = _index_blocks(source, block_size) if len(source) >= block_size else {}
+
+    i = 0
+    literal_start = 0
+    if index and n >= block_size:
+        a, b = _weak_hash(target, 0, block_size)
+    while index and i + block_size <= n:
+        best_off = -1
+        best_len = 0
+        for off in index.get((b << 16) | a, ()):
+            if source[off:off + block_size] != target[i:i + block_size]:
+                continue
+            length = block_size + _match_length(source, off + block_size, target, i + block_size)
+            if length > best_len:
+                best_off, best_len = off, length
+
+        if best_len:
+            # grow the match backwards over the pending literal bytes
+            while best_off > 0 and i > literal_start and source[best_off - 1] == target[i - 1]:
+                best_off -= 1
+                i -= 1
+                best_len += 1
+            writer.insert(target[literal_start:i])
+            writer.copy(best_off, best_len)
+            i += best_len
+            literal_start = i
+            if i + block_size <= n:
+                a, b = _weak_hash(target, i, block_size)
+            continue
+
+        # roll the checksum one byte forward
+        if i + block_size < n:
+            out_byte = target[i]
+            a = (a - out_byte + target[i + block_size]) & 0xffff
+            b = (b - block_size * out_byte + a) & 0xffff
+        i += 1
+
+    writer.insert(target[literal_start:])
+    return bytes(writer.out)
+
+
+def apply_delta(source, delta):
+    """Rebuild the target file from source and a delta made by make_delta()."""
+    if delta[:len(MAGIC)] != MAGIC:
+        raise ValueError("Invalid binary delta header")
+    target_length, pos = decode_varint(delta, len(MAGIC))
+    target = bytearray()
+    last_copy_end = 0
+    while pos < len(delta):
+        value, pos = decode_varint(delta, pos)
+        length = value >> 1
+        if value & 1:
+            diff, pos = decode_varint(delta, pos)
+            offset = last_copy_end + _unzigzag(diff)
+            target.extend(source[offset:offset + length])
+            last_copy_end = offset + length
+        else:
+            target.extend(delta[pos:pos + length])
+            pos += length
+    if len(target) != target_length:
+        raise ValueError("Binary delta produced {} bytes, expected {}".format(len(target), target_length))
+    return bytes(target)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# Persisted progress of an update campaign.
+#
+# OTAHandler records the multicast groups, the device states and the number of
+# frames enqueued so far in every group once the transfer starts. An updater
+# restarted after a crash finds the campaign of the same release and the same
+# devices, skips the multicast group setup and the frames the previous run
+# already handed to the network server, and carries on from there.
+#
+# The groups and devices are written once, when the transfer starts. The frame
+# counts of the groups change with every frame and go to a small file of their
+# own, <path>.progress, rewritten every PROGRESS_SAVE_INTERVAL updates.
+
+import json
+import os
+import threading
+
+
+# a resumed campaign sends again at most this many frames per group
+PROGRESS_SAVE_INTERVAL = 10
+PROGRESS_EXT = '.progress'
+
+
+def _write_json(path, data):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class CampaignState:
+
+    def __init__(self, path, save_interval=PROGRESS_SAVE_INTERVAL):
+        self._path = path
+        self._progress_path = path + PROGRESS_EXT if path else path
+        self._save_interval = save_interval
+        self._state = None
+        self._progress = dict()
+        # progress updates not written yet
+        self._unsaved = 0
+        # the transfers of the multicast groups run in parallel threads
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Return the saved state, or None if there is no usable one."""
+        if not self._path:
+            return None
+        try:
+            with open(self._path) as f:
+                self._state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print("Error loading campaign state {}: {}".format(self._path, e))
+            return None
+        # the progress was part of the state before it got its own file
+        self._progress = self._state.pop('progress', None) or dict()
+        try:
+            with open(self._progress_path) as f:
+                self._progress = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print("Error loading campaign progress {}, sending every frame again: {}".format(self._progress_path, e))
+            self._progress = dict()
+        return self._state
+
+    def save(self, state):
+        with self._lock:
+            self._state = dict(state)
+            if self._path:
+                _write_json(self._path, self._state)
+
+    def update(self, **fields):
+        with self._lock:
+            state = dict(self._state or dict())
+            state.update(fields)
+            self.save(state)
+
+    def progress(self, key):
+        """Saved progress of the transfer key, an empty dict if there is none."""
+        with self._lock:
+            return dict(self._progress.get(key) or dict())
+
+    def update_progress(self, key, flush=False, **fields):
+        """Update the progress of the transfer key, one per multicast group. It is written
+        every PROGRESS_SAVE_INTERVAL updates, right away with flush."""
+        with self._lock:
+            self._progress[key] = dict(self._progress.get(key) or dict(), **fields)
+            self._unsaved += 1
+            if flush or self._unsaved >= self._save_interval:
+                self._unsaved = 0
+                if self._progress_path:
+                    _write_json(self._progress_path, self._progress)
+
+    def clear(self):
+        with self._lock:
+            self._state = None
+            self._progress = dict()
+            self._unsaved = 0
+            for path in (self._path, self._progress_path):
+                if path and os.path.exists(path):
+                    os.remove(path)
@@ -1,5 +1,7 @@
 from pydantic import BaseSettings, validator
 from typing import List
+from .regions import REGIONS, max_payload
+from .delivery import DELIVERY_MODES
 
 class UpdaterConfig(BaseSettings):
     """Updater configuration parameters"""
@@ -12,8 +14,92 @@ class UpdaterConfig(BaseSettings):
     LORASERVER_TENANT_ID: str
     LORASERVER_DOWNLINK_DR: int = 5
     LORASERVER_DOWNLINK_FREQ: int = 869525000
+    LORASERVER_DOWNLINK_FREQS: List[int] = []
+    LORASERVER_REGION: str = 'EU868'
+    LORASERVER_DWELL_TIME: bool = False
+    LORASERVER_QUEUE_LOW_WATERMARK: int = 4
+    LORASERVER_QUEUE_HIGH_WATERMARK: int = 0
     LORASERVER_APP_ID: str
     DEVICE_EUI: List[str]
+    PATCH_CACHE_DIR: str = '../patch_cache'
+    PATCH_CACHE_MAX_SIZE: int = 64 * 1024 * 1024
+    PATCH_WORKERS: int = 1
+    PATCH_BUNDLE_DIR: str = '../patch_bundles'
+    PATCH_PATIENCE_EXT: List[str] = ['.py']
+    PATCH_DIFF_BUDGET: int = 2000000
+    PATCH_OPTIMIZE: bool = False
+    PATCH_ENCODING: str = 'text'
+    PATCH_ZDICT: str = ''
+    PATCH_ZDICT_DIR: str = '../zdict'
+    PATCH_FEC_REDUNDANCY: float = 0.0
+    PATCH_REPAIR_ROUNDS: int = 0
+    PATCH_STREAM: bool = False
+    CAMPAIGN_STATE_FILE: str = '../campaign_state.json'
+    DELIVERY_MODE: str = 'auto'
+    RENDEZVOUS_RATE: float = 1.0
+    RENDEZVOUS_RETRY_DELAY: float = 8.0
+    RENDEZVOUS_MAX_RETRY_DELAY: float = 120.0
+    ASYNC_ORCHESTRATION: bool = False
+    MQTT_WORKERS: int = 4
+    MQTT_QUEUE_SIZE: int = 10000
+
+    @validator('LORASERVER_REGION')
+    def check_region(cls, v):
+        if v not in REGIONS:
+            raise ValueError("LORASERVER_REGION must be one of {}".format(', '.join(REGIONS)))
+        return v
+
+    @validator('LORASERVER_DWELL_TIME')
+    def check_downlink_dr(cls, v, values):
+        # declared after the data rate and the region, checks them together
+        if 'LORASERVER_DOWNLINK_DR' in values and 'LORASERVER_REGION' in values:
+            try:
+                max_payload(values['LORASERVER_REGION'], values['LORASERVER_DOWNLINK_DR'], v)
+            except ValueError as e:
+                raise ValueError("LORASERVER_DOWNLINK_DR: {}".format(e))
+        return v
+
+    @validator('LORASERVER_DOWNLINK_FREQS')
+    def check_downlink_freqs(cls, v):
+        if len(set(v)) != len(v):
+            raise ValueError("LORASERVER_DOWNLINK_FREQS must not repeat a frequency")
+        return v
+
+    @validator('LORASERVER_QUEUE_HIGH_WATERMARK')
+    def check_queue_watermarks(cls, v, values):
+        if v > 0 and v <= values.get('LORASERVER_QUEUE_LOW_WATERMARK', 0):
+            raise ValueError("LORASERVER_QUEUE_HIGH_WATERMARK must be above LORASERVER_QUEUE_LOW_WATERMARK")
+        return v
+
+    @validator('PATCH_FEC_REDUNDANCY')
+    def check_fec_redundancy(cls, v):
+        if v < 0:
+            raise ValueError("PATCH_FEC_REDUNDANCY must be positive")
+        return v
+
+    @validator('DELIVERY_MODE')
+    def check_delivery_mode(cls, v):
+        if v not in DELIVERY_MODES:
+            raise ValueError("DELIVERY_MODE must be one of {}".format(', '.join(DELIVERY_MODES)))
+        return v
+
+    @validator('RENDEZVOUS_RATE', 'RENDEZVOUS_RETRY_DELAY', 'RENDEZVOUS_MAX_RETRY_DELAY')
+    def check_rendezvous(cls, v, field):
+        if v <= 0:
+            raise ValueError("{} must be positive".format(field.name))
+        return v
+
+    @validator('MQTT_WORKERS', 'MQTT_QUEUE_SIZE')
+    def check_mqtt_dispatch(cls, v, field):
+        if v <= 0:
+            raise ValueError("{} must be positive".format(field.name))
+        return v
+
+    @validator('PATCH_ENCODING')
+    def check_patch_encoding(cls, v):
+        if v not in ['text', 'binary']:
+            raise ValueError("PATCH_ENCODING must be 'text' or 'binary'")
+        return v
 
     class Config:
         env_prefix = "INPUT_"
\ No newline at end of file
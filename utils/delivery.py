@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+#
+# Choice between multicast and unicast delivery of an update.
+#
+# A multicast group costs a fixed setup: the group and its members are created
+# through the LoRa server API, every device gets its multicast keys as a class A
+# downlink and switches to class C before the transfer starts, and the group is
+# deleted at the end. The update frames are then sent once. Unicast delivery
+# skips the setup but sends every frame to every device. Both are estimated
+# with the duty cycle pacing of the downlinks, the cheaper one wins.
+
+from .airtime import DUTY_CYCLE_WINDOW
+from collections import namedtuple
+import math
+
+AUTO = 'auto'
+MULTICAST = 'multicast'
+UNICAST = 'unicast'
+DELIVERY_MODES = [AUTO, MULTICAST, UNICAST]
+
+# estimated duration of a LoRa server API request
+API_ROUND_TRIP = 0.5
+
+DeliveryCost = namedtuple('DeliveryCost', ['duration', 'airtime'])
+
+
+def paced_duration(airtime, duty_cycle, window=DUTY_CYCLE_WINDOW):
+    """Seconds needed to send airtime seconds of frames within the duty cycle."""
+    if duty_cycle is None or airtime <= 0:
+        return airtime
+    budget = duty_cycle * window
+    # the budget of a window goes out back to back, the rest waits for the next windows
+    full_windows = math.ceil(airtime / budget) - 1
+    return full_windows * window + airtime - full_windows * budget
+
+
+def multicast_cost(frame_lengths, nb_devices, scheduler, keys_length, setup_delay):
+    """Cost of the multicast delivery, setup_delay being the waits of the key distribution."""
+    airtime = nb_devices * scheduler.airtime(keys_length) + sum(scheduler.airtime(length) for length in frame_lengths)
+    # create the group, add every device, delete the group
+    api_time = (nb_devices + 2) * API_ROUND_TRIP
+    return DeliveryCost(api_time + setup_delay + paced_duration(airtime, scheduler.duty_cycle), airtime)
+
+
+def unicast_cost(frame_lengths, nb_devices, scheduler):
+    """Cost of sending every frame to every device."""
+    airtime = nb_devices * sum(scheduler.airtime(length) for length in frame_lengths)
+    return DeliveryCost(paced_duration(airtime, scheduler.duty_cycle), airtime)
+
+
+def choose_delivery(multicast, unicast):
+    """MULTICAST or UNICAST, the shortest delivery then the least airtime."""
+    if (unicast.duration, unicast.airtime) < (multicast.duration, multicast.airtime):
+        return UNICAST
+    return MULTICAST
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# State of the devices of an update campaign.
+#
+# Every uplink moves one device to the next phase of the campaign: it replied
+# to the update info, it listens to its multicast group, it reported its new
+# version. DeviceTable keeps one small record per device and a counter per
+# phase, updated on every transition, so whether the whole fleet reached a
+# phase is known without looking at the other devices.
+
+import threading
+
+
+class DeviceState:
+    """Phase of one device, and its multicast group once the groups are created."""
+
+    __slots__ = ('version', 'replied', 'listening', 'finished', 'group')
+
+    def __init__(self, version=None, replied=False, listening=False, finished=False):
+        self.version = version
+        self.replied = replied
+        self.listening = listening
+        self.finished = finished
+        self.group = None
+
+
+class DeviceTable:
+
+    def __init__(self, devices=()):
+        self._devices = dict()
+        # number of devices in every phase
+        self.replied = 0
+        self.listening = 0
+        self.finished = 0
+        # held by the callers chaining several transitions, the MQTT and update threads share the table
+        self.lock = threading.RLock()
+        for dev_eui in devices:
+            self.add(dev_eui)
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, dev_eui):
+        return dev_eui in self._devices
+
+    def devices(self):
+        with self.lock:
+            return list(self._devices)
+
+    def get(self, dev_eui):
+        return self._devices.get(dev_eui)
+
+    def add(self, dev_eui, version=None, replied=False, listening=False, finished=False):
+        with self.lock:
+            self.remove(dev_eui)
+            self._devices[dev_eui] = DeviceState(version, replied, listening, finished)
+            self.replied += replied
+            self.listening += listening
+            self.finished += finished
+
+    def remove(self, dev_eui):
+        with self.lock:
+            device = self._devices.pop(dev_eui, None)
+            if device is None:
+                return False
+            self.replied -= device.replied
+            self.listening -= device.listening
+            self.finished -= device.finished
+            return True
+
+    def set_version(self, dev_eui, version):
+        """Record the version reported by dev_eui, False if it is not in the table."""
+        with self.lock:
+            device = self._devices.get(dev_eui)
+            if device is None:
+                return False
+            device.version = version
+            if not device.replied:
+                device.replied = True
+                self.replied += 1
+            return True
+
+    def set_listening(self, dev_eui):
+        """Mark dev_eui listening, False if it is not in the table or already listening."""
+        with self.lock:
+            device = self._devices.get(dev_eui)
+            if device is None or device.listening:
+                return False
+            device.listening = True
+            self.listening += 1
+            return True
+
+    def set_finished(self, dev_eui):
+        """Mark the update of dev_eui finished, False if it is not in the table or already finished."""
+        with self.lock:
+            device = self._devices.get(dev_eui)
+            if device is None or device.finished:
+                return False
+            device.finished = True
+            self.finished += 1
+            return True
+
+    def all_replied(self):
+        return self.replied == len(self._devices)
+
+    def all_listening(self):
+        return self.listening == len(self._devices)
+
+    def all_finished(self):
+        return self.finished == len(self._devices)
+
+    def by_version(self):
+        """Devices of every reported version."""
+        devices_versions = dict()
+        with self.lock:
+            for dev_eui, device in self._devices.items():
+                devices_versions.setdefault(device.version, []).append(dev_eui)
+        return devices_versions
+
+    def to_dict(self):
+        """JSON serializable states, in the format of the campaign state file."""
+        with self.lock:
+            return {dev_eui: {'update_info_reply': device.replied, 'version': device.version,
+                              'listening': device.listening, 'update_finished': device.finished}
+                    for dev_eui, device in self._devices.items()}
+
+    @classmethod
+    def from_dict(cls, devices):
+        table = cls()
+        for dev_eui, device in devices.items():
+            table.add(dev_eui, device['version'], device['update_info_reply'], device['listening'],
+                      device['update_finished'])
+        return table
@@ -33,11 +33,17 @@ Applies the patch onto another text, allowing for errors.
 
 __author__ = 'fraser@google.com (Neil Fraser)'
 
+import bisect
 import re
 import sys
 import time
 import urllib.parse
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 
 class diff_match_patch:
   """Class containing the diff, match and patch methods.
@@ -52,8 +58,24 @@ class diff_match_patch:
 
     # Number of seconds to map a diff before giving up (0 for infinity).
     self.Diff_Timeout = 1.0
+    # Number of edit graph steps (diagonals walked by diff_bisect) a diff may
+    # spend before giving up, 0 to use Diff_Timeout instead.  Unlike the
+    # timeout the result does not depend on the speed or load of the machine.
+    self.Diff_EditBudget = 0
+    # Edit graph steps left for the current diff_main call.
+    self._diff_effort = None
     # Cost of an empty edit operation in terms of edit characters.
     self.Diff_EditCost = 4
+    # Let diff_bisect switch to the vectorised NumPy implementation when the
+    # edit distance grows large.  Same output, only used if NumPy is installed.
+    self.Diff_FastBisect = True
+    # Algorithm of the line-level pass of diff_lineMode, 'myers' or 'patience'.
+    self.Diff_LineStrategy = 'myers'
+    # With the patience strategy, replacement blocks where both sides are
+    # longer than this are left as whole lines instead of being rediffed
+    # character-by-character.  Those are moved or rewritten blocks, where a
+    # character diff costs a lot of time for a patch that compresses worse.
+    self.Diff_PatienceRefineMax = 1024
     # At what point is no match declared (0.0 = perfection, 1.0 = very loose).
     self.Match_Threshold = 0.5
     # How far to search for a match (0 = exact location, 1000+ = broad match).
@@ -101,8 +123,13 @@ class diff_match_patch:
     """
     # Set a deadline by which time the diff must be complete.
     if deadline == None:
+      self._diff_effort = None
       # Unlike in most languages, Python counts time in seconds.
-      if self.Diff_Timeout <= 0:
+      if self.Diff_EditBudget > 0:
+        # Effort bounded diff, the budget replaces the wall-clock deadline.
+        self._diff_effort = self.Diff_EditBudget
+        deadline = sys.maxsize
+      elif self.Diff_Timeout <= 0:
         deadline = sys.maxsize
       else:
         deadline = time.time() + self.Diff_Timeout
@@ -219,7 +246,10 @@ class diff_match_patch:
     # Scan the text on a line-by-line basis first.
     (text1, text2, linearray) = self.diff_linesToChars(text1, text2)
 
-    diffs = self.diff_main(text1, text2, False, deadline)
+    if self.Diff_LineStrategy == 'patience':
+      diffs = self.diff_patience(text1, text2, deadline)
+    else:
+      diffs = self.diff_main(text1, text2, False, deadline)
 
     # Convert the diff back to original text.
     self.diff_charsToLines(diffs, linearray)
@@ -227,6 +257,9 @@ class diff_match_patch:
     self.diff_cleanupSemantic(diffs)
 
     # Rediff any replacement blocks, this time character-by-character.
+    refine_max = sys.maxsize
+    if self.Diff_LineStrategy == 'patience':
+      refine_max = self.Diff_PatienceRefineMax
     # Add a dummy entry at the end.
     diffs.append((self.DIFF_EQUAL, ''))
     pointer = 0
@@ -243,7 +276,8 @@ class diff_match_patch:
         text_delete += diffs[pointer][1]
       elif diffs[pointer][0] == self.DIFF_EQUAL:
         # Upon reaching an equality, check for prior redundancies.
-        if count_delete >= 1 and count_insert >= 1:
+        if (count_delete >= 1 and count_insert >= 1 and
+            min(len(text_delete), len(text_insert)) <= refine_max):
           # Delete the offending records and add the merged ones.
           subDiff = self.diff_main(text_delete, text_insert, False, deadline)
           diffs[pointer - count_delete - count_insert : pointer] = subDiff
@@ -259,6 +293,106 @@ class diff_match_patch:
 
     return diffs
 
+  # Edit distance at which diff_bisect switches to diff_bisectVector.  Below
+  # it the per step NumPy overhead outweighs the gain.
+  _VECTOR_BISECT_MIN_D = 96
+
+  def diff_patience(self, text1, text2, deadline):
+    """Patience diff.  Lines present exactly once in both texts are used as
+      anchors, the longest run of anchors in the same order is kept and the
+      gaps between them are diffed recursively.  Gaps without any unique line
+      fall back to diff_main.  Meant for the line-level pass of diff_lineMode,
+      where each character stands for a whole line.
+
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+      deadline: Time when the diff should be complete by.
+
+    Returns:
+      Array of changes.
+    """
+    diffs = []
+    self._diff_patienceGap(text1, text2, deadline, diffs)
+    self.diff_cleanupMerge(diffs)
+    return diffs
+
+  def _diff_patienceGap(self, text1, text2, deadline, diffs):
+    """Append the patience diff of text1 and text2 to diffs."""
+    # Trim off common prefix and suffix, they are not anchors.
+    commonlength = self.diff_commonPrefix(text1, text2)
+    if commonlength:
+      diffs.append((self.DIFF_EQUAL, text1[:commonlength]))
+      text1 = text1[commonlength:]
+      text2 = text2[commonlength:]
+    commonlength = self.diff_commonSuffix(text1, text2)
+    commonsuffix = ''
+    if commonlength:
+      commonsuffix = text1[-commonlength:]
+      text1 = text1[:-commonlength]
+      text2 = text2[:-commonlength]
+
+    anchors = self._diff_patienceAnchors(text1, text2)
+    if not anchors:
+      diffs.extend(self.diff_main(text1, text2, False, deadline))
+    else:
+      start1 = 0
+      start2 = 0
+      for (pos1, pos2) in anchors:
+        self._diff_patienceGap(text1[start1:pos1], text2[start2:pos2],
+                               deadline, diffs)
+        diffs.append((self.DIFF_EQUAL, text1[pos1]))
+        start1 = pos1 + 1
+        start2 = pos2 + 1
+      self._diff_patienceGap(text1[start1:], text2[start2:], deadline, diffs)
+
+    if commonsuffix:
+      diffs.append((self.DIFF_EQUAL, commonsuffix))
+
+  def _diff_patienceAnchors(self, text1, text2):
+    """Longest increasing run of the characters unique in both texts.
+
+    Returns:
+      List of (index in text1, index in text2) tuples, in order.
+    """
+    counts = {}
+    for i, char in enumerate(text1):
+      if char in counts:
+        counts[char][0] += 1
+      else:
+        counts[char] = [1, 0, i, -1]
+    for i, char in enumerate(text2):
+      entry = counts.get(char)
+      if entry is not None:
+        entry[1] += 1
+        entry[3] = i
+    unique = sorted((entry[2], entry[3]) for entry in counts.values()
+                    if entry[0] == 1 and entry[1] == 1)
+    if not unique:
+      return []
+
+    # Patience sorting on the positions in text2.
+    tails = []       # tails[n] = smallest text2 position ending a run of n+1
+    tail_index = []  # index in unique of that position
+    previous = [-1] * len(unique)
+    for i, (_, pos2) in enumerate(unique):
+      n = bisect.bisect_left(tails, pos2)
+      if n == len(tails):
+        tails.append(pos2)
+        tail_index.append(i)
+      else:
+        tails[n] = pos2
+        tail_index[n] = i
+      previous[i] = tail_index[n - 1] if n > 0 else -1
+
+    anchors = []
+    i = tail_index[-1]
+    while i != -1:
+      anchors.append(unique[i])
+      i = previous[i]
+    anchors.reverse()
+    return anchors
+
   def diff_bisect(self, text1, text2, deadline):
     """Find the 'middle snake' of a diff, split the problem in two
       and return the recursively constructed diff.
@@ -272,7 +406,6 @@ class diff_match_patch:
     Returns:
       Array of diff tuples.
     """
-
     # Cache the text lengths to prevent multiple calls.
     text1_length = len(text1)
     text2_length = len(text2)
@@ -292,11 +425,22 @@ class diff_match_patch:
     k1end = 0
     k2start = 0
     k2end = 0
+    vector = self.Diff_FastBisect and numpy is not None
     for d in range(max_d):
       # Bail out if deadline is reached.
       if time.time() > deadline:
         break
 
+      if vector and d == self._VECTOR_BISECT_MIN_D:
+        # Long edit path, carry on with all the diagonals at once.
+        return self.diff_bisectVector(text1, text2, deadline, d, v1, v2,
+                                      (k1start, k1end, k2start, k2end))
+
+      # Bail out if the edit budget is spent.
+      if not self.diff_spendEffort(len(range(-d + k1start, d + 1 - k1end, 2)) +
+                                   len(range(-d + k2start, d + 1 - k2end, 2))):
+        break
+
       # Walk the front path one step.
       for k1 in range(-d + k1start, d + 1 - k1end, 2):
         k1_offset = v_offset + k1
@@ -361,6 +505,191 @@ class diff_match_patch:
     # number of diffs equals number of characters, no commonality at all.
     return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
 
+  def diff_bisectVector(self, text1, text2, deadline, d_start, v1, v2, bounds):
+    """Continue diff_bisect from step d_start with NumPy, returns the very
+      same diff.  The texts are coded as integer arrays and each step of the
+      front and reverse paths is computed for all the diagonals at once.
+      Snakes are followed in lockstep and the few long ones are finished by
+      comparing whole blocks.
+
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+      deadline: Time at which to bail if not yet complete.
+      d_start: First step to walk.
+      v1: Front path state of diff_bisect after d_start steps.
+      v2: Reverse path state of diff_bisect after d_start steps.
+      bounds: Tuple (k1start, k1end, k2start, k2end) of diff_bisect.
+
+    Returns:
+      Array of diff tuples.
+    """
+    text1_length = len(text1)
+    text2_length = len(text2)
+    max_d = (text1_length + text2_length + 1) // 2
+    v_offset = max_d
+    v_length = 2 * max_d
+    # One spare slot so v[k + 1] can be read for k == d as well, the value is
+    # discarded exactly like the short-circuit in diff_bisect does.
+    v1 = numpy.array(v1 + [-1], dtype=numpy.int64)
+    v2 = numpy.array(v2 + [-1], dtype=numpy.int64)
+    delta = text1_length - text2_length
+    # If the total number of characters is odd, then the front path will
+    # collide with the reverse path.
+    front = (delta % 2 != 0)
+
+    # Integer coded texts, the reversed copies turn the reverse path into a
+    # forward scan.  Each array ends with a sentinel that matches nothing so
+    # snakes stop at the edge of the graph.
+    codes1 = self._diff_codes(text1, 0xFFFFFFFF)
+    codes2 = self._diff_codes(text2, 0xFFFFFFFE)
+    rcodes1 = self._diff_codes(text1[::-1], 0xFFFFFFFF)
+    rcodes2 = self._diff_codes(text2[::-1], 0xFFFFFFFE)
+
+    (k1start, k1end, k2start, k2end) = bounds
+    for d in range(d_start, max_d):
+      # Bail out if deadline is reached.
+      if time.time() > deadline:
+        break
+
+      # Bail out if the edit budget is spent.
+      if not self.diff_spendEffort(len(range(-d + k1start, d + 1 - k1end, 2)) +
+                                   len(range(-d + k2start, d + 1 - k2end, 2))):
+        break
+
+      # Walk the front path one step.
+      k1 = numpy.arange(-d + k1start, d + 1 - k1end, 2, dtype=numpy.int64)
+      if len(k1):
+        k1_offset = v_offset + k1
+        before = v1[k1_offset - 1]
+        after = v1[k1_offset + 1]
+        x1 = numpy.where((k1 == -d) | ((k1 != d) & (before < after)),
+                         after, before + 1)
+        x1 = self._diff_snakeVector(x1, x1 - k1, codes1, codes2,
+                                    text1_length, text2_length)
+        y1 = x1 - k1
+        v1[k1_offset] = x1
+        off_right = x1 > text1_length
+        off_bottom = ~off_right & (y1 > text2_length)
+        if front:
+          k2_offset = v_offset + delta - k1
+          overlap = ~off_right & ~off_bottom & (k2_offset >= 0) & (k2_offset < v_length)
+          if overlap.any():
+            x2 = v2[numpy.where(overlap, k2_offset, 0)]
+            overlap &= (x2 != -1) & (x1 >= text1_length - x2)
+            hits = numpy.flatnonzero(overlap)
+            if len(hits):
+              # Overlap detected, on the first diagonal in walking order.
+              i = hits[0]
+              return self.diff_bisectSplit(text1, text2, int(x1[i]), int(y1[i]),
+                                           deadline)
+        k1end += 2 * int(numpy.count_nonzero(off_right))
+        k1start += 2 * int(numpy.count_nonzero(off_bottom))
+
+      # Walk the reverse path one step.
+      k2 = numpy.arange(-d + k2start, d + 1 - k2end, 2, dtype=numpy.int64)
+      if len(k2):
+        k2_offset = v_offset + k2
+        before = v2[k2_offset - 1]
+        after = v2[k2_offset + 1]
+        x2 = numpy.where((k2 == -d) | ((k2 != d) & (before < after)),
+                         after, before + 1)
+        x2 = self._diff_snakeVector(x2, x2 - k2, rcodes1, rcodes2,
+                                    text1_length, text2_length)
+        y2 = x2 - k2
+        v2[k2_offset] = x2
+        off_left = x2 > text1_length
+        off_top = ~off_left & (y2 > text2_length)
+        if not front:
+          k1_offset = v_offset + delta - k2
+          overlap = ~off_left & ~off_top & (k1_offset >= 0) & (k1_offset < v_length)
+          if overlap.any():
+            x1 = v1[numpy.where(overlap, k1_offset, 0)]
+            # Mirror x2 onto top-left coordinate system.
+            overlap &= (x1 != -1) & (x1 >= text1_length - x2)
+            hits = numpy.flatnonzero(overlap)
+            if len(hits):
+              i = hits[0]
+              x = int(x1[i])
+              y = v_offset + x - int(k1_offset[i])
+              return self.diff_bisectSplit(text1, text2, x, y, deadline)
+        k2end += 2 * int(numpy.count_nonzero(off_left))
+        k2start += 2 * int(numpy.count_nonzero(off_top))
+
+    # Diff took too long and hit the deadline or
+    # number of diffs equals number of characters, no commonality at all.
+    return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
+
+  def _diff_codes(self, text, sentinel):
+    """Integer array with the code points of text followed by sentinel."""
+    codes = numpy.empty(len(text) + 1, dtype=numpy.uint32)
+    codes[:-1] = numpy.frombuffer(text.encode('utf-32-le', 'surrogatepass'),
+                                  dtype=numpy.uint32)
+    codes[-1] = sentinel
+    return codes
+
+  # Snakes are followed in lockstep until no more than this many are still
+  # running, those are finished one at a time with block comparisons.
+  _SNAKE_BLOCK_LANES = 4
+
+  def _diff_snakeVector(self, x, y, codes1, codes2, text1_length, text2_length):
+    """Follow the diagonals starting at (x[i], y[i]) while both texts match.
+
+    Args:
+      x: Array of start points in text1, modified in place.
+      y: Array of start points in text2.
+      codes1: Integer coded text1 ending with a sentinel.
+      codes2: Integer coded text2 ending with a different sentinel.
+      text1_length: Length of text1.
+      text2_length: Length of text2.
+
+    Returns:
+      The array of end points in text1.
+    """
+    active = numpy.flatnonzero((x < text1_length) & (y < text2_length) & (y >= 0))
+    if not len(active):
+      return x
+    y = y.copy()
+    while len(active) > self._SNAKE_BLOCK_LANES:
+      active = active[codes1[x[active]] == codes2[y[active]]]
+      x[active] += 1
+      y[active] += 1
+    for i in active:
+      xi = int(x[i])
+      yi = int(y[i])
+      limit = min(text1_length - xi, text2_length - yi)
+      n = 0
+      step = 64
+      while n < limit:
+        step = min(step, limit - n)
+        mismatch = numpy.flatnonzero(codes1[xi + n:xi + n + step] !=
+                                     codes2[yi + n:yi + n + step])
+        if len(mismatch):
+          n += int(mismatch[0])
+          break
+        n += step
+        step *= 4
+      x[i] = xi + n
+    return x
+
+  def diff_spendEffort(self, steps):
+    """Take steps out of the edit budget of the current diff.
+
+    Args:
+      steps: Number of edit graph steps about to be walked.
+
+    Returns:
+      False if the budget can not cover them, True otherwise or if the diff
+      is not effort bounded.
+    """
+    if self._diff_effort is None:
+      return True
+    if steps > self._diff_effort:
+      self._diff_effort = 0
+      return False
+    self._diff_effort -= steps
+    return True
+
   def diff_bisectSplit(self, text1, text2, x, y, deadline):
     """Given the location of the 'middle snake', split the diff in two parts
     and recurse.
@@ -576,7 +905,7 @@ class diff_match_patch:
       the prefix of text2, the suffix of text2 and the common middle.  Or None
       if there was no match.
     """
-    if self.Diff_Timeout <= 0:
+    if self.Diff_Timeout <= 0 and self.Diff_EditBudget <= 0:
       # Don't risk returning a non-optimal diff if we have unlimited time.
       return None
     if len(text1) > len(text2):
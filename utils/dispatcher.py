@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+# Hand-off of the MQTT messages to worker threads.
+#
+# paho calls on_message on its network thread, a slow handler there delays the
+# keepalives and every other uplink. MessageDispatcher only puts the message on
+# the bounded queue of a worker and returns. The messages of a device always go
+# to the same worker, so they are handled in the order they arrived while the
+# devices spread over the workers are handled concurrently. A full queue drops
+# the messages the campaign asks for again, e.g. the update info replies, and
+# only waits for room for the others, which are few per device.
+
+import queue
+import threading
+import zlib
+from .uplink import topic_device_eui
+
+
+class MessageDispatcher:
+
+    def __init__(self, handler, workers=4, queue_size=10000, droppable=None):
+        self._handler = handler
+        # droppable(topic, payload), whether a message may be dropped when its worker is behind
+        self._droppable = droppable if droppable is not None else (lambda topic, payload: True)
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = [threading.Thread(target=self._work, args=(q,), daemon=True) for q in self._queues]
+        # messages dropped because their worker was behind
+        self.dropped = 0
+        for thread in self._threads:
+            thread.start()
+
+    def _shard(self, topic):
+        # stable across runs, unlike hash()
+        key = topic_device_eui(topic) or topic
+        return self._queues[zlib.crc32(key.encode()) % len(self._queues)]
+
+    def dispatch(self, topic, payload):
+        """Queue the message for its worker, only blocks for the messages that cannot be dropped."""
+        messages = self._shard(topic)
+        try:
+            messages.put_nowait((topic, payload))
+        except queue.Full:
+            if not self._droppable(topic, payload):
+                messages.put((topic, payload))
+                return
+            self.dropped += 1
+            if self.dropped & (self.dropped - 1) == 0:
+                print(f"MQTT workers are behind, {self.dropped} messages dropped")
+
+    def _work(self, messages):
+        while True:
+            message = messages.get()
+            if message is None:
+                return
+            try:
+                self._handler(*message)
+            except Exception as e:
+                print(f"Error processing message on {message[0]}: {e}")
+
+    def stop(self):
+        """Let the workers finish the queued messages and wait for them."""
+        for messages in self._queues:
+            messages.put(None)
+        for thread in self._threads:
+            thread.join()
@@ -1,11 +1,18 @@
+import io
 import os
 import shutil
+import subprocess
+import tarfile
+import tempfile
 
 
 PREV_VERSION_DIR = 'prev_version'
 NEW_VERSION_DIR = 'new_version'
 FIRMWARE_DIR = 'firmware'
+PATCH_BUNDLE_DIR = 'patch_bundles'
+ZDICT_DIR = 'zdict'
 VERSION_FILE = 'version.py'
+SRC_DIR = 'src'
 
 def get_version():
     with open(VERSION_FILE) as f:
@@ -20,12 +27,24 @@ def list_files(startpath):
         for f in files:
             print('{}{}'.format(subindent, f))
 
-def move_files():
+def workspace_items(paths):
+    """Workspace entries of the paths, given relative to NEW_VERSION_DIR like ../patch_bundles."""
+    items = set()
+    for path in paths:
+        parts = os.path.normpath(path).split(os.sep)
+        if len(parts) > 1 and parts[0] == os.pardir:
+            items.add(parts[1])
+    return items
+
+def move_files(keep=()):
+    # the items of keep stay in the workspace, the campaign reads them from ../
     new_dir = PREV_VERSION_DIR
     os.makedirs(new_dir, exist_ok=True)  # create the new directory if it doesn't already exist
 
     for item in os.listdir('.'):
         print(item)
+        if item in keep:
+            continue
         if os.path.isfile(item):  # check if the item is a file
             shutil.move(item, os.path.join(new_dir, item))  # move the file to the new directory
         elif os.path.isdir(item) and item != new_dir:  # check if the item is a directory
@@ -47,3 +66,60 @@ def move_files():
     os.chdir('..')
     os.system(f'mkdir ../{FIRMWARE_DIR}/{dev_version}')
     os.system(f'mv ./src/* ../{FIRMWARE_DIR}/{dev_version}')
+
+def _git(repo_dir, *args):
+    return subprocess.run(['git'] + list(args), cwd=repo_dir, capture_output=True, check=True).stdout
+
+def _version_commits(repo_dir):
+    """(commit, version) of the commits that changed src/version.py, most recent first."""
+    version_path = SRC_DIR + '/' + VERSION_FILE
+    for commit in _git(repo_dir, 'log', '--format=%H', '--', version_path).decode().split():
+        try:
+            yield commit, _git(repo_dir, 'show', commit + ':' + version_path).decode().strip()
+        except subprocess.CalledProcessError:
+            # the commit deleting the version file
+            continue
+
+def _export_commit(commit, version, firmware_dir, repo_dir):
+    archive = _git(repo_dir, 'archive', '--format=tar', commit, SRC_DIR)
+    # extracted aside, another campaign may be exporting the same version. Next to firmware_dir rather than
+    # in it, a run killed during the extraction must not leave a directory the version scans would read
+    firmware_dir = os.path.abspath(firmware_dir)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(firmware_dir), prefix='.' + os.path.basename(firmware_dir) + '-')
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        for member in tar.getmembers():
+            name = os.path.relpath(member.name, SRC_DIR)
+            if name == '.' or name.startswith('..') or not (member.isfile() or member.isdir()):
+                continue
+            member.name = name
+            tar.extract(member, tmp_dir)
+    try:
+        os.rename(tmp_dir, os.path.join(firmware_dir, version))
+    except OSError:
+        shutil.rmtree(tmp_dir)
+    print("Firmware {} extracted from commit {}".format(version, commit))
+
+def export_version(version, firmware_dir, repo_dir='.'):
+    """Extract the firmware of version from the git history of repo_dir to firmware_dir/version.
+
+    The version is looked up in the src/version.py of the commits that changed it, return
+    False if no commit has it or the history is not available (e.g. a shallow clone).
+    """
+    try:
+        for commit, commit_version in _version_commits(repo_dir):
+            if commit_version == version:
+                _export_commit(commit, version, firmware_dir, repo_dir)
+                return os.path.isdir(os.path.join(firmware_dir, version))
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("Error looking up firmware {} in the git history: {}".format(version, e))
+    return False
+
+def export_history(firmware_dir, repo_dir='.'):
+    """Extract every version of the git history of repo_dir missing from firmware_dir, return their number."""
+    os.makedirs(firmware_dir, exist_ok=True)
+    exported = 0
+    for commit, version in _version_commits(repo_dir):
+        if not os.path.isdir(os.path.join(firmware_dir, version)):
+            _export_commit(commit, version, firmware_dir, repo_dir)
+            exported += 1
+    return exported
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# Forward error correction of the multicast patches, in the style of the
+# LoRaWAN fragmented data block transport (TS004).
+#
+# A patch is cut into nb_frag fragments of the same size, the last one padded
+# with zeros. Fragments 1..nb_frag are sent as is, then every redundancy
+# fragment nb_frag + n is the XOR of the fragments selected by
+# parity_row(n, nb_frag), the pseudo random matrix line of TS004. A device
+# that received any nb_frag linearly independent fragments rebuilds the patch,
+# whichever ones were lost.
+#
+# Fragment payloads on the air are a 2 bytes big endian index followed by the
+# fragment. FragmentDecoder is the reference decoder for the device side, it
+# runs a Gaussian elimination over GF(2) as the fragments arrive.
+
+import math
+
+
+INDEX_SIZE = 2
+
+
+def _prbs23(x):
+    b0 = x & 1
+    b1 = (x & 32) >> 5
+    return (x >> 1) + ((b0 ^ b1) << 22)
+
+
+def parity_row(n, nb_frag):
+    """Bit mask of the fragments XORed in the n-th redundancy fragment (n counts from 1)."""
+    m = 1 if nb_frag & (nb_frag - 1) == 0 else 0
+    x = 1 + 1001 * n
+    row = 0
+    for _ in range(nb_frag // 2):
+        r = 1 << 16
+        while r >= nb_frag:
+            x = _prbs23(x)
+            r = x % (nb_frag + m)
+        row |= 1 << r
+    # a single fragment block has no matrix, repeat the fragment
+    return row or 1
+
+
+def redundancy_count(nb_frag, redundancy):
+    return int(math.ceil(nb_frag * redundancy))
+
+
+def encode_fragments(data, frag_size, redundancy):
+    """Return (fragments, padding), fragments being the uncoded ones followed by the redundancy ones."""
+    nb_frag = max(1, int(math.ceil(len(data) / float(frag_size))))
+    padding = nb_frag * frag_size - len(data)
+    data = bytes(data) + bytes(padding)
+    fragments = [data[i * frag_size:(i + 1) * frag_size] for i in range(nb_frag)]
+
+    values = [int.from_bytes(f, 'big') for f in fragments]
+    for n in range(1, redundancy_count(nb_frag, redundancy) + 1):
+        row = parity_row(n, nb_frag)
+        parity = 0
+        for i in range(nb_frag):
+            if row >> i & 1:
+                parity ^= values[i]
+        fragments.append(parity.to_bytes(frag_size, 'big'))
+    return fragments, padding
+
+
+def fragment_payload(index, fragment):
+    """Fragment as sent on the air, index counts from 1."""
+    return index.to_bytes(INDEX_SIZE, 'big') + fragment
+
+
+class FragmentDecoder:
+    """Rebuild a patch from any nb_frag independent fragments."""
+
+    def __init__(self, nb_frag, frag_size, padding):
+        self.nb_frag = nb_frag
+        self.frag_size = frag_size
+        self.padding = padding
+        # pivot bit -> (row, value), rows reduced against the previous pivots
+        self._pivots = dict()
+        self.received = set()
+
+    def _row(self, index):
+        if index <= self.nb_frag:
+            return 1 << (index - 1)
+        return parity_row(index - self.nb_frag, self.nb_frag)
+
+    def add_payload(self, payload):
+        return self.add(int.from_bytes(payload[:INDEX_SIZE], 'big'), payload[INDEX_SIZE:])
+
+    def add(self, index, fragment):
+        """Add a fragment, return True once the patch can be rebuilt."""
+        if index in self.received or self.complete():
+            return self.complete()
+        self.received.add(index)
+        row = self._row(index)
+        value = int.from_bytes(fragment, 'big')
+        for bit, (pivot_row, pivot_value) in self._pivots.items():
+            if row >> bit & 1:
+                row ^= pivot_row
+                value ^= pivot_value
+        if row == 0:
+            # linearly dependent, no new information
+            return False
+        bit = (row & -row).bit_length() - 1
+        # keep the pivot column clear in the other rows
+        for other, (other_row, other_value) in self._pivots.items():
+            if other_row >> bit & 1:
+                self._pivots[other] = (other_row ^ row, other_value ^ value)
+        self._pivots[bit] = (row, value)
+        return self.complete()
+
+    def complete(self):
+        return len(self._pivots) == self.nb_frag
+
+    def missing(self):
+        """Indexes of the uncoded fragments not received."""
+        return [i for i in range(1, self.nb_frag + 1) if i not in self.received]
+
+    def data(self):
+        if not self.complete():
+            raise ValueError("{} of {} fragments".format(len(self._pivots), self.nb_frag))
+        # fully reduced, every pivot row is a single fragment
+        data = b''.join(self._pivots[i][1].to_bytes(self.frag_size, 'big') for i in range(self.nb_frag))
+        return data[:len(data) - self.padding]
@@ -22,47 +22,348 @@
 # possibility of such damage.
 
 from .diff_match_patch import diff_match_patch
+from .patchCache import PatchCache
+from .binaryDelta import make_delta, DEFAULT_BLOCK_SIZE
+from .patchCodec import encode_patches
+from .patchBundle import bundle_path, tree_hash, save_bundle, load_bundle
+from .zdict import compress, decompress, load_zdict, get_zdict, register_zdicts
+from .fragmentation import encode_fragments, fragment_payload, INDEX_SIZE
+from .multicastQueue import MulticastQueue, UnicastQueue
+from .updateStream import encode_stream, OP_DELETE, OP_TEXT_PATCH, OP_BIN_PATCH, OP_DELTA
+from distutils.version import LooseVersion
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import hashlib
 import binascii
 import filecmp
 import json
-import time
 import os
 import zlib
 
 
+# Files sent as binary deltas, the rest is diffed as text.
+BINARY_EXT = ['.mpy', '.bin', '.img', '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.ico']
+
+# Candidate diff strategies of the patch optimizer, every combination of
+# line/char mode, cleanup (with its Diff_EditCost) and Patch_Margin is tried.
+OPTIMIZER_LINE_MODES = [True, False]
+OPTIMIZER_CLEANUPS = [('semantic', 4), ('efficiency', 2), ('efficiency', 4), ('efficiency', 8)]
+OPTIMIZER_MARGINS = [2, 4, 8]
+
+
+def optimizer_strategies():
+    strategies = []
+    for line_mode in OPTIMIZER_LINE_MODES:
+        for cleanup, edit_cost in OPTIMIZER_CLEANUPS:
+            for margin in OPTIMIZER_MARGINS:
+                strategies.append({
+                    'line_mode': line_mode,
+                    'cleanup': cleanup,
+                    'Diff_EditCost': edit_cost,
+                    'Patch_Margin': margin,
+                })
+    return strategies
+
+
+def strategy_name(strategy):
+    return '{}/{}/cost{}/margin{}'.format('line' if strategy['line_mode'] else 'char', strategy['cleanup'],
+                                          strategy['Diff_EditCost'], strategy['Patch_Margin'])
+
+
+def _make_strategy_patch(left_text, right_text, diff_settings, strategy, encoding, zdict_id):
+    dmp = diff_match_patch()
+    for name, value in diff_settings.items():
+        setattr(dmp, name, value)
+    if strategy is None:
+        patch_lst = dmp.patch_make(left_text, right_text)
+    else:
+        dmp.Diff_EditCost = strategy['Diff_EditCost']
+        dmp.Patch_Margin = strategy['Patch_Margin']
+        diffs = dmp.diff_main(left_text, right_text, strategy['line_mode'])
+        if len(diffs) > 2:
+            if strategy['cleanup'] == 'semantic':
+                dmp.diff_cleanupSemantic(diffs)
+            dmp.diff_cleanupEfficiency(diffs)
+        patch_lst = dmp.patch_make(left_text, diffs)
+    if encoding == 'binary':
+        patch_data = encode_patches(patch_lst)
+    else:
+        patch_data = dmp.patch_toText(patch_lst)
+    # compress patch
+    return patch_data, compress(patch_data if encoding == 'binary' else patch_data.encode(), zdict_id)
+
+
+def make_patch(left_text, right_text, diff_settings):
+    """Diff, compress and hash one file. Module level so it can run in a process pool.
+
+    With a 'strategies' list in diff_settings every strategy is tried and the
+    patch with the smallest compressed size wins. 'encoding' selects between
+    patch_toText ('text') and the compact patchCodec format ('binary'). 'zdict'
+    is the id of a registered preset dictionary used to compress the patch.
+    """
+    settings = dict(diff_settings)
+    strategies = settings.pop('strategies', None)
+    encoding = settings.pop('encoding', 'text')
+    zdict_id = settings.pop('zdict', None)
+    if not strategies:
+        patch_str, compressed_patch = _make_strategy_patch(left_text, right_text, settings, None, encoding, zdict_id)
+        strategy = 'default'
+    else:
+        best = None
+        for candidate in strategies:
+            result = _make_strategy_patch(left_text, right_text, settings, candidate, encoding, zdict_id)
+            # ties keep the earlier, cheaper to compute, strategy
+            if best is None or len(result[1]) < len(best[1]):
+                best = result
+                strategy = strategy_name(candidate)
+        patch_str, compressed_patch = best
+
+    h = hashlib.sha1()
+    h.update(patch_str if encoding == 'binary' else patch_str.encode())
+    hash = binascii.hexlify(h.digest()).decode()
+    return patch_str, compressed_patch, hash, strategy
+
+
+def make_binary_patch(left_data, right_data, delta_settings):
+    """Binary delta counterpart of make_patch."""
+    delta = make_delta(left_data, right_data, delta_settings['block_size'])
+
+    h = hashlib.sha1()
+    h.update(delta)
+    hash = binascii.hexlify(h.digest()).decode()
+    compressed_delta = zlib.compress(delta)
+    return delta, compressed_delta, hash, 'delta'
+
+
 class updateHandler:
     
-    def __init__(self, dev_version, latest_version, clientApp, api_key, multicast_id, ota_obj):
+    def __init__(self, dev_version, latest_version, clientApp, api_key, multicast_id, ota_obj,
+                 cache_dir=None, cache_max_size=0, patch_workers=1, bundle_dir=None, firmware_dir=None,
+                 patience_ext=('.py',), diff_budget=0, optimize=False, patch_encoding='text',
+                 zdict_dir=None, zdict='', fec_redundancy=0, repair_rounds=0,
+                 queue_low_watermark=0, queue_high_watermark=0, stream=False,
+                 campaign_state=None, resume_frames=0, resume_hash=None, tx_scheduler=None,
+                 unicast_device=None):
         self.tag = dev_version + ',' + latest_version
         self.oper_dict = None
         self.patch_dict = None
+        self.delta_dict = None
+        # winning diff strategy of every patch, for reporting
+        self.patch_strategies = dict()
         self.dev_version = dev_version
         self.latest_version = latest_version
         self._clientApp = clientApp
         self.ota =ota_obj
+        self.firmware_dir = firmware_dir if firmware_dir is not None else ota_obj.firmware_dir
+        self._bundle_dir = bundle_dir
         
         self._loraserver_api_key = api_key
         self._multicast_group_id = multicast_id
+        # device the frames are sent to as unicast downlinks, None sends them to the multicast group
+        self._unicast_device = unicast_device
+        # with a high watermark the network server paces the frames, else the duty cycle scheduler does
+        self._pipelined = queue_high_watermark > 0 and unicast_device is None
+        # scheduler of the sub-band of the multicast group frequency
+        self._tx_scheduler = tx_scheduler if tx_scheduler is not None else getattr(ota_obj, 'tx_scheduler', None)
+        # airtime of the frames of this group, the sub-band scheduler may be shared
+        self.total_airtime = 0.0
+        if unicast_device is not None:
+            self._multicast_queue = UnicastQueue(ota_obj, unicast_device)
+        else:
+            self._multicast_queue = MulticastQueue(clientApp, api_key, multicast_id,
+                                                   queue_low_watermark, queue_high_watermark)
         
-        self._binary_ext = []
+        self._binary_ext = list(BINARY_EXT)
+
+        # diff_match_patch settings, also part of the patch cache key.
+        # A non zero edit budget makes the patches independent of the machine load.
+        self._diff_settings = {
+            'Diff_Timeout': 1.0,
+            'Diff_EditBudget': diff_budget,
+            'Diff_EditCost': 4,
+            'Patch_Margin': 4,
+            'Match_MaxBits': 32,
+        }
+        if patch_encoding != 'text':
+            self._diff_settings['encoding'] = patch_encoding
+        self._patch_encoding = patch_encoding
+        # preset dictionary of the patch compression, the devices must have it installed
+        self._zdict = zdict
+        if zdict:
+            load_zdict(zdict_dir, zdict)
+            self._diff_settings['zdict'] = zdict
+        if optimize:
+            # try every candidate strategy and keep the smallest patch
+            self._diff_settings['strategies'] = optimizer_strategies()
+        # line diff strategy by file extension, the rest uses diff_match_patch's default
+        self._line_strategies = dict((ext, 'patience') for ext in patience_ext)
+        self._delta_settings = {
+            'block_size': DEFAULT_BLOCK_SIZE,
+        }
+        self._patch_cache = None
+        if cache_dir:
+            self._patch_cache = PatchCache(cache_dir, cache_max_size)
+        # number of processes used to generate patches, 1 diffs files serially
+        self._patch_workers = patch_workers
+        # redundancy fragments sent per patch fragment, 0 sends the patches without FEC
+        self._fec_redundancy = fec_redundancy
+        # progress of the campaign, frames already enqueued by an interrupted run are skipped
+        self._campaign_state = campaign_state
+        self._resume_frames = resume_frames
+        self._resume_hash = resume_hash
+        self._frame_index = 0
+        # the repair rounds depend on the device replies, their frames are not counted
+        self._count_frames = True
+        # every file operation in a single compressed stream
+        self._stream = stream
+        # rounds of selective retransmission after the first pass, 0 disables them
+        self._repair_rounds = repair_rounds
+        # (patch type, fragments, fragment size, padding) of every indexed patch, by session number
+        self._fragment_sessions = []
+        # frames kept instead of sent, see _capture()
+        self._captured = None
         
+    def prepare_patches(self):
+        """Load or build the patches, unless another handler shared them already."""
+        if self.patch_dict is None and not self.load_bundle():
+            self.build_patches()
+
+    def share_patches(self, handler):
+        """Send the patches of handler, the groups of an update all get the same ones."""
+        self.oper_dict = handler.oper_dict
+        self.patch_dict = handler.patch_dict
+        self.delta_dict = handler.delta_dict
+
     def start(self):
         try:
-            self.oper_dict = self.file_operations(self.dev_version, self.latest_version)
-            self.patch_dict = self._create_patches(self.dev_version, self.latest_version, self.oper_dict)
+            self.prepare_patches()
+            self._check_resume()
             
-            self._send_patches(self.patch_dict)
-            self._send_delete_operations(self.oper_dict)
-            self._send_manifest_msg()
+            self._send_transfer()
+            if self._repair_rounds > 0:
+                self._repair_fragments()
+            self._send_closing()
+            print("Estimated airtime of {}: {:.1f} s".format(self._multicast_group_id, self.total_airtime))
             
-            while not self.ota.is_empty_multicast_queue(self._loraserver_api_key, self._multicast_group_id):
-                time.sleep(1)
+            self._multicast_queue.drain()
         
-            self.ota.delete_multicast_group()
+            group_deleted = True
+            if self._unicast_device is None:
+                group_deleted = self.ota.delete_multicast_group(self._multicast_group_id)
+            if self._campaign_state is not None:
+                # a resumed campaign must not send to the group, the next campaign deletes it if it is still there
+                self._campaign_state.update_progress(self._multicast_group_id, flush=True, completed=True,
+                                                     group_deleted=group_deleted)
         except Exception as e:
             print("error in updateHandler start method: {}".format(e))
             self.ota.failed_update()
+
+    def _send_transfer(self):
+        if self._stream:
+            self._send_stream()
+        elif self._patch_encoding == 'binary':
+            self._send_patches(self.patch_dict, self.ota.UPDATE_TYPE_BIN_PATCH)
+        else:
+            self._send_patches(self.patch_dict)
+        if not self._stream:
+            self._send_patches(self.delta_dict, self.ota.UPDATE_TYPE_DELTA)
+
+    def _send_closing(self):
+        if not self._stream:
+            self._send_delete_operations(self.oper_dict)
+        self._send_manifest_msg()
+
+    def _capture(self, send, *args):
+        """Frames send(*args) enqueues, nothing is sent."""
+        self._captured = []
+        try:
+            send(*args)
+            return self._captured
+        finally:
+            self._captured = None
+
+    def frame_lengths(self):
+        """Lengths of the frames of the update without repair rounds, nothing is sent."""
+        self.prepare_patches()
+        try:
+            return [len(msg) for msg in self._capture(self._send_transfer) + self._capture(self._send_closing)]
+        finally:
+            self._fragment_sessions = []
+
+    # The frames of the update for a caller that sends them itself, in this order:
+    # transfer_frames(), the repair rounds (repair_request_frames() then repair_frames()
+    # with the fragments the devices miss), closing_frames().
+
+    def transfer_frames(self):
+        self.prepare_patches()
+        return self._capture(self._send_transfer)
+
+    def repair_request_frames(self, repair_round):
+        return self._capture(self._send_multicast_msg, self.ota.REPAIR_REQUEST_MSG, str(repair_round))
+
+    def repair_frames(self, missing):
+        return self._capture(self._send_repairs, missing)
+
+    def closing_frames(self):
+        return self._capture(self._send_closing)
+
+    def transfer_hash(self):
+        # the frames of the first pass only depend on these
+        transfer = {
+            'oper_dict': self.oper_dict,
+            'patches': [[fname, hashlib.sha1(compressed).hexdigest()] for fname, (compressed, _) in self.patch_dict.items()],
+            'deltas': [[fname, hashlib.sha1(compressed).hexdigest()] for fname, (compressed, _) in self.delta_dict.items()],
+            'max_payload': self.ota.max_payload,
+            'encoding': self._patch_encoding,
+            'fec_redundancy': self._fec_redundancy,
+            'repair_rounds': self._repair_rounds,
+            'stream': self._stream,
+        }
+        return hashlib.sha1(json.dumps(transfer, sort_keys=True).encode()).hexdigest()
+
+    def _check_resume(self):
+        transfer_hash = self.transfer_hash()
+        if self._resume_frames > 0 and transfer_hash != self._resume_hash:
+            print("The patches changed since the interrupted run, sending every frame again")
+            self._resume_frames = 0
+        elif self._resume_frames > 0:
+            print("Skipping the {} frames enqueued by the interrupted run".format(self._resume_frames))
+        if self._campaign_state is not None:
+            self._campaign_state.update_progress(self._multicast_group_id, flush=True, transfer_hash=transfer_hash,
+                                                 sent_frames=self._resume_frames)
+
+    def build_patches(self):
+        self.oper_dict = self.file_operations(self.dev_version, self.latest_version)
+        self.patch_dict = self._create_patches(self.dev_version, self.latest_version, self.oper_dict)
+        self.delta_dict = self._create_deltas(self.dev_version, self.latest_version, self.oper_dict)
+
+    def _bundle_fingerprint(self):
+        # a bundle is only valid for the same firmware trees and patch settings
+        return {
+            'source': tree_hash(self.firmware_dir + '/' + self.dev_version),
+            'target': tree_hash(self.firmware_dir + '/' + self.latest_version),
+            'binary_ext': self._binary_ext,
+            'diff_settings': self._diff_settings,
+            'line_strategies': self._line_strategies,
+            'delta_settings': self._delta_settings,
+        }
+
+    def save_bundle(self):
+        path = bundle_path(self._bundle_dir, self.dev_version, self.latest_version)
+        save_bundle(path, self._bundle_fingerprint(), self.oper_dict, self.patch_dict, self.delta_dict)
+        return path
+
+    def load_bundle(self):
+        if not self._bundle_dir:
+            return False
+        path = bundle_path(self._bundle_dir, self.dev_version, self.latest_version)
+        bundle = load_bundle(path, self._bundle_fingerprint())
+        if bundle is None:
+            return False
+        self.oper_dict, self.patch_dict, self.delta_dict = bundle
+        print("Loaded precomputed patch bundle {}".format(path))
+        self.print_file_operations(self.oper_dict)
+        return True
         
     def print_file_operations(self, oper_dict):
         if 'delete_txt' in oper_dict:
@@ -75,18 +376,23 @@ class updateHandler:
             print('New binary: {}'.format(oper_dict['new_bin']))
         if 'update_txt' in oper_dict:
             print('Update {}'.format(oper_dict['update_txt']))
+        if 'update_bin' in oper_dict:
+            print('Update binary: {}'.format(oper_dict['update_bin']))
             
     def _create_manifest(self, oper_dict):
         manifest = {"delete":0, "update":0, "new":0}
         for key, value in oper_dict.items():
-            if 'delete_txt' in key:
-                manifest['delete'] = len(value)
-            elif 'new_txt' in key:
-                manifest['new'] = len(value)
-            elif 'update_txt' in key:
-                manifest['update'] = len(value)
-                
-        return json.dumps(manifest)
+            if key in ['delete_txt', 'delete_bin']:
+                manifest['delete'] += len(value)
+            elif key in ['new_txt', 'new_bin']:
+                manifest['new'] += len(value)
+            elif key in ['update_txt', 'update_bin']:
+                manifest['update'] += len(value)
+        if self._zdict:
+            manifest['zdict'] = self._zdict
+
+        # compact, it has to fit in a single downlink
+        return json.dumps(manifest, separators=(',', ':'))
                 
     def get_all_paths(self, path, ignore=[]):
         ignore = set(ignore)
@@ -112,7 +418,8 @@ class updateHandler:
     def text_binary_separation(self, paths, key):
         path_dict = dict()
 
-        for path in paths:
+        # sorted, the transmission order must be the same on every run to resume a campaign
+        for path in sorted(paths):
             filename, extension = os.path.splitext(path)
             if extension in self._binary_ext:
                 if key + '_bin' not in path_dict:
@@ -134,15 +441,14 @@ class updateHandler:
 
         paths_dict = self.text_binary_lists(to_delete, new_files)
 
-        for f in common:
+        for f in sorted(common):
             if not filecmp.cmp(os.path.join(left, f),
                os.path.join(right, f), shallow=False):
                filename, extension = os.path.splitext(f)
                if extension in self._binary_ext:
-                   # No diff update for binary files
-                   if 'new_bin' not in paths_dict:
-                       paths_dict['update_txt'] = []
-                   paths_dict['new_bin'].append(f)
+                   if 'update_bin' not in paths_dict:
+                       paths_dict['update_bin'] = []
+                   paths_dict['update_bin'].append(f)
                else:
                    if 'update_txt' not in paths_dict:
                        paths_dict['update_txt'] = []
@@ -150,12 +456,15 @@ class updateHandler:
 
         return paths_dict
     
-    def _read_firware_file(self, filename):
-        text = ''
+    def _read_firware_file(self, filename, binary=False):
+        text = b'' if binary else ''
         try:
-            text = open(filename).read()
-        except Exception as e:
+            with open(filename, 'rb' if binary else 'r') as f:
+                text = f.read()
+        except FileNotFoundError:
             pass
+        except Exception as e:
+            print("Error reading firmware file {}: {}".format(filename, e))
         return text
     
     def _create_hash(self, data):
@@ -174,7 +483,7 @@ class updateHandler:
         msg.extend(b',' + filename.encode())
         msg.extend(b',' + self.ota.MSG_TAIL)
         
-        self._clientApp.send(self._loraserver_api_key, self._multicast_group_id, msg)
+        self._enqueue(msg)
     
     def _send_delete_operations(self, oper_dict):
         for key, value in oper_dict.items():
@@ -182,22 +491,101 @@ class updateHandler:
                 for filename in value:
                     self._send_delete_msg(filename)
         
-    def _send_patches(self, patch_dict):
+    def _send_patches(self, patch_dict, patch_type=None):
+        if patch_type is None:
+            patch_type = self.ota.UPDATE_TYPE_PATCH
         for fname in patch_dict:
             #send file name to patch
             self._send_multicast_msg(self.ota.UPDATE_TYPE_FNAME, fname)
-            time.sleep(4)
-            # corta el parche en trozos de 200 caracteres y los envia
-            patch_list = self.chunk_string(patch_dict[fname][0], 200)
+            self._send_patch_data(patch_dict[fname][0], patch_dict[fname][1], patch_type)
+
+    def _send_patch_data(self, data, checksum, patch_type):
+        if self._fec_redundancy > 0 or self._repair_rounds > 0:
+            self._send_fec_fragments(data, patch_type)
+        else:
+            # cut the patch in fragments that fill the downlinks
+            patch_list = self.chunk_string(data, self._fragment_size(patch_type))
             for p in patch_list:
                 # send segmented patch
-                self._send_multicast_msg(self.ota.UPDATE_TYPE_PATCH, p)
-                time.sleep(4)
-            checksum = patch_dict[fname][1]
-            # Send checksum
-            self._send_multicast_msg(self.ota.UPDATE_TYPE_CHECKSUM, checksum)
-            time.sleep(4)
-            
+                self._send_multicast_msg(patch_type, p)
+        # Send checksum
+        self._send_multicast_msg(self.ota.UPDATE_TYPE_CHECKSUM, checksum)
+
+    def build_stream(self):
+        """Return the compressed update stream of every file operation and its checksum."""
+        records = []
+        text_op = OP_BIN_PATCH if self._patch_encoding == 'binary' else OP_TEXT_PATCH
+        zdict = get_zdict(self._zdict) if self._zdict else None
+        for fname, (compressed_patch, _) in self.patch_dict.items():
+            patch = decompress(compressed_patch, zdict) if zdict else zlib.decompress(compressed_patch)
+            records.append((text_op, fname, patch))
+        for fname, (compressed_delta, _) in self.delta_dict.items():
+            records.append((OP_DELTA, fname, zlib.decompress(compressed_delta)))
+        for key in ['delete_txt', 'delete_bin']:
+            for filename in self.oper_dict.get(key, []):
+                records.append((OP_DELETE, filename, b''))
+
+        stream = encode_stream(records)
+        h = hashlib.sha1()
+        h.update(stream)
+        return compress(stream, self._zdict), binascii.hexlify(h.digest()).decode()
+
+    def _send_stream(self):
+        compressed_stream, checksum = self.build_stream()
+        print("Update stream: {} bytes".format(len(compressed_stream)))
+        self._send_patch_data(compressed_stream, checksum, self.ota.UPDATE_TYPE_STREAM)
+
+    def _send_fec_fragments(self, data, patch_type):
+        frag_size = self._fragment_size(self.ota.UPDATE_TYPE_FRAGMENT) - INDEX_SIZE
+        fragments, padding = encode_fragments(data, frag_size, self._fec_redundancy)
+        nb_frag = (len(data) + padding) // frag_size
+        self._fragment_sessions.append((patch_type, fragments, nb_frag, frag_size, padding))
+        self._send_fragments(len(self._fragment_sessions) - 1, range(1, len(fragments) + 1))
+
+    def _send_fragments(self, session, indexes):
+        patch_type, fragments, nb_frag, frag_size, padding = self._fragment_sessions[session]
+        # $OTA,12,<patch type>,<fragments>,<fragment size>,<padding>,<session>,*
+        session_msg = '{},{},{},{},{}'.format(patch_type, nb_frag, frag_size, padding, session)
+        self._send_multicast_msg(self.ota.UPDATE_TYPE_FRAG_SESSION, session_msg)
+        for i in indexes:
+            self._send_multicast_msg(self.ota.UPDATE_TYPE_FRAGMENT, fragment_payload(i, fragments[i - 1]))
+
+    def _repair_fragments(self):
+        """Resend the fragments the devices report missing until all of them have every patch."""
+        self._count_frames = False
+        try:
+            for repair_round in range(1, self._repair_rounds + 1):
+                self.ota.clear_repair_replies(self._multicast_group_id)
+                # $OTA,15,<round>,*
+                self._send_multicast_msg(self.ota.REPAIR_REQUEST_MSG, str(repair_round))
+                # the reply timeout starts once the request is on the air
+                self._multicast_queue.drain()
+                complete, missing = self.ota.wait_repair_replies(self._multicast_group_id)
+                if complete:
+                    print("Every device received all the fragments")
+                    return True
+                print("Repair round {}: {} missing fragments in {} patches".format(
+                    repair_round, sum(len(m) for m in missing.values()), len(missing)))
+                self._send_repairs(missing)
+            print("Fragments still missing after {} repair rounds".format(self._repair_rounds))
+            return False
+        finally:
+            self._count_frames = True
+
+    def _send_repairs(self, missing):
+        for session in sorted(missing):
+            if not 0 <= session < len(self._fragment_sessions):
+                continue
+            nb_sent = len(self._fragment_sessions[session][1])
+            self._send_fragments(session, [i for i in sorted(missing[session]) if 1 <= i <= nb_sent])
+
+    def _msg_overhead(self, msg_type):
+        # $OTA,<type>,<data>,*
+        return len(self.ota.MSG_HEADER) + len(str(msg_type)) + len(self.ota.MSG_TAIL) + 3
+
+    def _fragment_size(self, msg_type):
+        return self.ota.max_payload - self._msg_overhead(msg_type)
+
     def _send_multicast_msg(self, msg_type, data):
         
         msg = bytearray()
@@ -207,37 +595,107 @@ class updateHandler:
             data = data.encode()
         msg.extend(b',' + data)
         msg.extend(b',' + self.ota.MSG_TAIL)
-        self._clientApp.send(self._loraserver_api_key, self._multicast_group_id, msg)
+        if len(msg) > self.ota.max_payload:
+            print("Warning: {} bytes message of type {} exceeds the {} bytes maximum payload".format(
+                len(msg), msg_type, self.ota.max_payload))
+        self._enqueue(msg)
+
+    def _enqueue(self, msg):
+        if self._captured is not None:
+            self._captured.append(bytes(msg))
+            return
+        if self._count_frames:
+            self._frame_index += 1
+            if self._frame_index <= self._resume_frames:
+                # already handed to the network server by the interrupted run
+                return
+        if self._pipelined:
+            # only accounts the airtime, the network server sends the frames back to back
+            self._tx_scheduler.reserve(len(msg))
+        else:
+            # released as soon as the duty cycle of the downlink sub-band allows it
+            self._tx_scheduler.wait(len(msg))
+        self.total_airtime += self._tx_scheduler.airtime(len(msg))
+        if not self._multicast_queue.put(msg):
+            # the progress stays at the previous frame, a resumed campaign sends this one again
+            raise RuntimeError("frame {} of {} was not accepted by the network server".format(
+                self._frame_index, self._multicast_group_id))
+        if self._count_frames and self._campaign_state is not None:
+            self._campaign_state.update_progress(self._multicast_group_id, sent_frames=self._frame_index)
     
-    def _create_file_patch(self, left, right, fileList):
+    def _make_patches(self, texts, patch_func):
+        if self._patch_workers > 1 and len(texts) > 1:
+            lefts = [t[0] for t in texts]
+            rights = [t[1] for t in texts]
+            settings = [t[2] for t in texts]
+            workers = min(self._patch_workers, len(texts))
+            # the workers need the preset dictionary to compress the patches
+            zdicts = [get_zdict(self._zdict)] if self._zdict else []
+            # spawned, a forked worker could inherit a lock held by the MQTT, watchdog or group threads
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=register_zdicts, initargs=(zdicts,)) as executor:
+                # map keeps the results in the same order as fileList
+                return list(executor.map(patch_func, lefts, rights, settings))
+
+        return [patch_func(left_text, right_text, settings) for left_text, right_text, settings in texts]
+
+    def _file_diff_settings(self, filename):
+        _, extension = os.path.splitext(filename)
+        if extension not in self._line_strategies:
+            return self._diff_settings
+        settings = dict(self._diff_settings)
+        settings['Diff_LineStrategy'] = self._line_strategies[extension]
+        return settings
+
+    def _create_file_patch(self, left, right, fileList, binary=False):
         patch_dict = dict()
+        patch_func = make_binary_patch if binary else make_patch
 
-        for f in fileList:
-            left_text = self._read_firware_file(left + '/' + f)
-            right_text = self._read_firware_file(right + '/' + f)
+        results = [None] * len(fileList)
+        keys = [None] * len(fileList)
+        missing = []
+        for i, f in enumerate(fileList):
+            left_text = self._read_firware_file(left + '/' + f, binary)
+            right_text = self._read_firware_file(right + '/' + f, binary)
+            settings = self._delta_settings if binary else self._file_diff_settings(f)
 
-            dmp = diff_match_patch()
+            if self._patch_cache is not None:
+                keys[i] = self._patch_cache.make_key(left_text, right_text, settings)
+                results[i] = self._patch_cache.get(keys[i])
+            if results[i] is None:
+                missing.append((i, left_text, right_text, settings))
 
-            # Execute one reverse diff as a warmup.
-            patch_lst = dmp.patch_make(left_text, right_text)
-            patch_str = dmp.patch_toText(patch_lst)
+        patches = self._make_patches([m[1:] for m in missing], patch_func)
+        for (i, _, _, _), result in zip(missing, patches):
+            results[i] = result
+            if keys[i] is not None:
+                self._patch_cache.put(keys[i], *result)
 
-            print("File name: {}".format(f))
-            print("Patch : {}".format(patch_str))
+        missing_idx = set(m[0] for m in missing)
+        for i, f in enumerate(fileList):
+            patch_str, compressed_patch, hash, strategy = results[i]
+            if i in missing_idx:
+                print("File name: {} (strategy: {})".format(f, strategy))
+            else:
+                print("File name: {} (cached patch, strategy: {})".format(f, strategy))
+            if binary:
+                print("Delta : {} bytes".format(len(patch_str)))
+            elif type(patch_str) is bytes:
+                print("Patch : {} bytes".format(len(patch_str)))
+            else:
+                print("Patch : {}".format(patch_str))
 
             idx = f.find('/flash') + 1
-            hash = self._create_hash(patch_str)
-            # compress patch
-            compressed_patch = zlib.compress(patch_str.encode())
             patch_dict[f[idx:]] = (compressed_patch, hash)
+            self.patch_strategies[f[idx:]] = strategy
 
         return patch_dict
         
     def file_operations(self, device_version, update_version):
         oper_dict = dict()
 
-        left = self.ota.firmware_dir + '/' + device_version
-        right = self.ota.firmware_dir + '/' + update_version
+        left = self.firmware_dir + '/' + device_version
+        right = self.firmware_dir + '/' + update_version
         if os.path.isdir(left):
             oper_dict = self.get_diff_list(left, right)
         else:
@@ -250,8 +708,8 @@ class updateHandler:
     def _create_patches(self, device_version, update_version, oper_dict):
         patch_dict = dict()
 
-        left = self.ota.firmware_dir + '/' + device_version
-        right = self.ota.firmware_dir + '/' + update_version
+        left = self.firmware_dir + '/' + device_version
+        right = self.firmware_dir + '/' + update_version
 
         if 'update_txt' in oper_dict:
             update_dict = self._create_file_patch(left, right, oper_dict['update_txt'])
@@ -262,17 +720,49 @@ class updateHandler:
             patch_dict.update(new_dict)
 
         return patch_dict
+
+    def _create_deltas(self, device_version, update_version, oper_dict):
+        delta_dict = dict()
+
+        left = self.firmware_dir + '/' + device_version
+        right = self.firmware_dir + '/' + update_version
+
+        if 'update_bin' in oper_dict:
+            update_dict = self._create_file_patch(left, right, oper_dict['update_bin'], binary=True)
+            delta_dict.update(update_dict)
+
+        if 'new_bin' in oper_dict:
+            # delta against the missing file, a single insert with the whole content
+            new_dict = self._create_file_patch(left, right, oper_dict['new_bin'], binary=True)
+            delta_dict.update(new_dict)
+
+        return delta_dict
     
     def _send_manifest_msg(self):
         manifest = self._create_manifest(self.oper_dict)
-        print('Manifest: {}'.format(manifest))
+        if self._captured is None:
+            print('Manifest: {}'.format(manifest))
         
         for i in range(3):
             self._send_multicast_msg(self.ota.MANIFEST_MSG, manifest)
-            time.sleep(4)
-    
-    
-        
-    
-    
-    
+
+
+def precompute_bundles(firmware_dir, bundle_dir, window=0, **handler_kwargs):
+    """Build the patch bundles from every older version (or the last window ones) to the latest."""
+    versions = [d for d in os.listdir(firmware_dir) if os.path.isdir(os.path.join(firmware_dir, d))]
+    if len(versions) == 0:
+        print("No firmware versions found in {}".format(firmware_dir))
+        return []
+    versions.sort(key=LooseVersion)
+    latest_version = versions.pop()
+    if window > 0:
+        versions = versions[-window:]
+
+    paths = []
+    for dev_version in versions:
+        print("Precomputing patches {} -> {}".format(dev_version, latest_version))
+        handler = updateHandler(dev_version, latest_version, None, None, None, None,
+                                bundle_dir=bundle_dir, firmware_dir=firmware_dir, **handler_kwargs)
+        handler.build_patches()
+        paths.append(handler.save_bundle())
+    return paths
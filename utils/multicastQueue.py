@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# Pipelined enqueue to the ChirpStack multicast queue.
+#
+# Instead of pacing every frame locally, MulticastQueue keeps the network
+# server queue between a low and a high watermark and lets the network server
+# transmit the Class C frames back to back. The queue length is only polled
+# once the high watermark is reached, so neither the HTTP round trips nor the
+# local sleeps sit between two frames on the air. UnicastQueue sends the same
+# frames to a single device when unicast delivery is cheaper. A frame the
+# network server did not accept is sent again up to SEND_RETRIES times, put()
+# returns whether it was accepted in the end.
+
+import time
+
+SEND_RETRIES = 3
+SEND_RETRY_DELAY = 2.0
+
+
+def _send_retried(send, *args):
+    for attempt in range(SEND_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(SEND_RETRY_DELAY)
+        if send(*args):
+            return True
+    return False
+
+
+class MulticastQueue:
+
+    def __init__(self, client, api_key, group_id, low_watermark=0, high_watermark=0, poll_interval=0.5):
+        self._client = client
+        self._api_key = api_key
+        self._group_id = group_id
+        self._low = low_watermark
+        # 0 never waits for the queue, the caller paces the frames
+        self._high = high_watermark
+        self._poll_interval = poll_interval
+        # frames enqueued since the queue length was last read
+        self._depth = 0
+
+    def _length(self):
+        length = self._client.multicast_queue_length(self._api_key, self._group_id)
+        # an unreadable queue is considered empty, as is_empty_multicast_queue does
+        return max(length, 0)
+
+    def put(self, msg):
+        if self._high > 0 and self._depth >= self._high:
+            self._depth = self._length()
+            while self._depth > self._low:
+                time.sleep(self._poll_interval)
+                self._depth = self._length()
+        if not _send_retried(self._client.send, self._api_key, self._group_id, msg):
+            return False
+        self._depth += 1
+        return True
+
+    def drain(self, poll_interval=1):
+        """Block until the network server sent every frame."""
+        while self._length() > 0:
+            time.sleep(poll_interval)
+        self._depth = 0
+
+
+class UnicastQueue:
+    """Same interface as MulticastQueue, for the frames of one device sent as unicast downlinks."""
+
+    def __init__(self, ota, dev_eui):
+        self._ota = ota
+        self._dev_eui = dev_eui
+
+    def put(self, msg):
+        return _send_retried(self._ota.send_payload, self._dev_eui, msg)
+
+    def drain(self, poll_interval=1):
+        # the device queue is not polled, the frames were paced by the caller
+        pass
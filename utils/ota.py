@@ -24,6 +24,14 @@
 from distutils.version import LooseVersion
 from .LoraServer import LoraServerClient
 from .groupUpdater import updateHandler
+from .airtime import channel_schedulers
+from .regions import max_payload
+from .campaignState import CampaignState
+from .rendezvous import Rendezvous
+from .deviceTable import DeviceTable
+from .uplink import UplinkDecoder, ota_msg_type
+from .files import export_version
+from .delivery import AUTO, UNICAST, multicast_cost, unicast_cost, choose_delivery
 import threading
 import json
 import base64
@@ -35,7 +43,21 @@ from .config import UpdaterConfig
 
 config = UpdaterConfig()
 
-class OTAHandler:
+
+def parse_missing_fragments(msg):
+    """Missing fragment indexes by session of a MISSING_FRAGMENTS_MSG, ValueError if malformed."""
+    # $OTA,14,<session>:<bitmap>;<session>:<bitmap>,*
+    # bitmap in hexadecimal, bit i set when fragment i + 1 is missing
+    missing = dict()
+    for entry in msg.split(",")[2].split(";"):
+        session, bitmap = entry.split(":")
+        bits = int(bitmap, 16)
+        missing[int(session)] = [i + 1 for i in range(bits.bit_length()) if bits >> i & 1]
+    return missing
+
+
+class OTAProtocol:
+    """Messages of the update protocol, shared by the campaign implementations."""
 
     MSG_HEADER = b'$OTA'
     MSG_TAIL = b'*'
@@ -54,6 +76,115 @@ class OTAHandler:
     UPDATE_TYPE_CHECKSUM = 7
     DELETE_FILE_MSG = 8
     MANIFEST_MSG = 9
+    UPDATE_TYPE_DELTA = 10
+    UPDATE_TYPE_BIN_PATCH = 11
+    UPDATE_TYPE_FRAG_SESSION = 12
+    UPDATE_TYPE_FRAGMENT = 13
+    MISSING_FRAGMENTS_MSG = 14
+    REPAIR_REQUEST_MSG = 15
+    FRAGMENTS_COMPLETE_MSG = 16
+    UPDATE_TYPE_STREAM = 17
+
+    # seconds given to the devices to answer the multicast keys before sending them again
+    KEYS_REPLY_TIMEOUT = 10
+    # seconds given to the devices to report their missing fragments
+    REPAIR_REPLY_TIMEOUT = 60
+    # seconds between the last device listening and the first update frame
+    UPDATE_START_DELAY = 5
+
+    def _create_update_info_msg(self):
+        # $OTA,1,1.17.1,1674930013,*
+        msg = bytearray()
+        msg.extend(self.MSG_HEADER)
+        msg.extend(b',' + str(self.UPDATE_INFO_MSG).encode())
+        msg.extend(b',' + self._latest_version.encode())
+        msg.extend(b',' + str(int(time.time())).encode())
+        msg.extend(b',' + self.MSG_TAIL)
+        return msg
+
+    def _create_multicast_keys_msg(self, keys, frequency=None):
+        # $OTA,3,mcAddr,mcNwkSKey,mcAppSKey,*
+        # $OTA,3,mcAddr,mcNwkSKey,mcAppSKey,frequency,* with several multicast groups
+        msg = bytearray()
+        msg.extend(self.MSG_HEADER)
+        msg.extend(b',' + str(self.MULTICAST_KEY_MSG).encode())
+
+        msg.extend(b',' + keys[1])
+        msg.extend(b',' + keys[2])
+        msg.extend(b',' + keys[3])
+        if frequency is not None:
+            msg.extend(b',' + str(frequency).encode())
+
+        msg.extend(b',' + self.MSG_TAIL)
+        return msg
+
+    def _downlink(self, dev_eui, data):
+        """MQTT topic and payload of a unicast downlink."""
+        b64Data = base64.b64encode(data)
+        payload = '{"devEui": "' + dev_eui + '","fPort":1,"data": "' + b64Data.decode() + '"}'
+        topic = "application/" + self._loraserver_app_id  + "/device/" + dev_eui + "/command/down"
+        return topic, payload
+
+    def _cheaper_delivery(self, version, devices, frame_lengths):
+        # $OTA,3,mcAddr,mcNwkSKey,mcAppSKey,*
+        keys_length = len(self.MSG_HEADER) + len(self.MSG_TAIL) + 8 + 32 + 32 + 6
+        multicast = multicast_cost(frame_lengths, len(devices), self.tx_scheduler, keys_length,
+                                   self.KEYS_REPLY_TIMEOUT + self.UPDATE_START_DELAY)
+        unicast = unicast_cost(frame_lengths, len(devices), self.tx_scheduler)
+        delivery = choose_delivery(multicast, unicast)
+        print(f"Delivery of {version} to {len(devices)} devices: multicast {multicast.duration:.1f} s "
+              f"({multicast.airtime:.1f} s airtime), unicast {unicast.duration:.1f} s ({unicast.airtime:.1f} s airtime), "
+              f"using {delivery}")
+        return delivery
+
+    def _has_source_tree(self, version):
+        """Whether the firmware of version is available, extracted from the git history if needed."""
+        if os.path.isdir(os.path.join(self.firmware_dir, version)):
+            return True
+        return export_version(version, self.firmware_dir)
+
+    def get_msg_type(self, msg):
+        msg_type = -1
+
+        try:
+            msg_type = int(msg.split(",")[1])
+        except Exception as ex:
+            print("Exception getting message type")
+
+        return msg_type
+
+    def get_msg_version(self, msg):
+        """Version of an UPDATE_INFO_REPLY or DEVICE_VERSION_MSG, None if the message is malformed."""
+        # $OTA,2,1.17.0,*
+        fields = msg.split(",")
+        if len(fields) < 4 or not fields[2]:
+            return None
+        return fields[2]
+
+    def decode_device_msg(self, payload):
+        dev_msg = None
+        try:
+            rx_pkt = json.loads(payload)
+            dev_msg = base64.b64decode(rx_pkt["data"])
+        except Exception as ex:
+            print("Exception decoding device message")
+        return dev_msg
+    
+    def get_device_eui(self, payload):
+        dev_eui = None
+        try:
+            dev_eui = json.loads(payload)["deviceInfo"]["devEui"]
+        except Exception as ex:
+            print("Exception extracting device eui")
+
+        return dev_eui
+
+
+class OTAHandler(OTAProtocol):
+
+    # attempts to delete a multicast group, and seconds between them
+    GROUP_DELETE_ATTEMPTS = 3
+    GROUP_DELETE_RETRY_DELAY = 2
 
     def __init__(self):
         self.exit = False
@@ -63,8 +194,8 @@ class OTAHandler:
         self._latest_version = '0.0.0'
         self.firmware_dir = '../firmware'
 
-        # mcId, mcAddr, mcNwkSKey, mcAppSKey
-        self._multicast_keys = list()
+        # keys (mcId, mcAddr, mcNwkSKey, mcAppSKey), frequency and devices of every multicast group
+        self._multicast_groups = list()
 
         self._clientApp = LoraServerClient()
         self._loraserver_api_key = config.LORASERVER_API_KEY
@@ -73,19 +204,63 @@ class OTAHandler:
 
         self._downlink_datarate = config.LORASERVER_DOWNLINK_DR
         self._downlink_freq = config.LORASERVER_DOWNLINK_FREQ
-
-        self._devices_eui_list = config.DEVICE_EUI
-        if len(self._devices_eui_list) == 0:
+        # one multicast group per frequency, the devices are split between them
+        self._downlink_freqs = config.LORASERVER_DOWNLINK_FREQS or [self._downlink_freq]
+        self._region = config.LORASERVER_REGION
+        # paces the downlinks of every frequency to the duty cycle of its sub-band
+        self._tx_schedulers = channel_schedulers(self._region, self._downlink_datarate, self._downlink_freqs)
+        self.tx_scheduler = self._tx_schedulers[self._downlink_freqs[0]]
+        # largest application payload of a downlink at the downlink data rate
+        self.max_payload = max_payload(self._region, self._downlink_datarate, config.LORASERVER_DWELL_TIME)
+
+        self._patch_cache_dir = config.PATCH_CACHE_DIR
+        self._patch_cache_max_size = config.PATCH_CACHE_MAX_SIZE
+        self._patch_workers = config.PATCH_WORKERS
+        self._patch_bundle_dir = config.PATCH_BUNDLE_DIR
+        self._patch_patience_ext = config.PATCH_PATIENCE_EXT
+        self._patch_diff_budget = config.PATCH_DIFF_BUDGET
+        self._patch_optimize = config.PATCH_OPTIMIZE
+        self._patch_encoding = config.PATCH_ENCODING
+        self._patch_zdict = config.PATCH_ZDICT
+        self._patch_zdict_dir = config.PATCH_ZDICT_DIR
+        self._patch_fec_redundancy = config.PATCH_FEC_REDUNDANCY
+        self._patch_repair_rounds = config.PATCH_REPAIR_ROUNDS
+        self._patch_stream = config.PATCH_STREAM
+        self._queue_low_watermark = config.LORASERVER_QUEUE_LOW_WATERMARK
+        self._queue_high_watermark = config.LORASERVER_QUEUE_HIGH_WATERMARK
+        self._delivery_mode = config.DELIVERY_MODE
+        self._rendezvous_rate = config.RENDEZVOUS_RATE
+        self._rendezvous_retry_delay = config.RENDEZVOUS_RETRY_DELAY
+        self._rendezvous_max_retry_delay = config.RENDEZVOUS_MAX_RETRY_DELAY
+        # query of the device versions, see start()
+        self._rendezvous = None
+
+        if len(config.DEVICE_EUI) == 0:
             print("No devices EUI found")
             exit(1)
-        self._devices_dict = dict()
-        self._devices_current_version = None
+        # phase of every device, the devices already up to date are removed from it
+        self._devices = DeviceTable()
+        # multicast group id -> group
+        self._groups_by_id = dict()
+        # only the uplinks of the fleet are parsed
+        self._uplink_decoder = UplinkDecoder(frozenset(config.DEVICE_EUI))
+        # version -> devices, once every device reported its version
+        self._devices_versions = None
+        # prepared patches of every source version, shared by the groups of the version
+        self._version_handlers = dict()
+        self._version_handlers_lock = threading.Lock()
         self._devices_failed_update = list()
+        self._update_started = False
+
+        # progress of the campaign, to resume it after a crash
+        self._campaign_state = CampaignState(config.CAMPAIGN_STATE_FILE)
+
+        # dev_eui -> None once complete, else session -> missing fragment indexes
+        self._repair_replies = dict()
+        self._repair_cond = threading.Condition()
         
         watchdog_thread = threading.Thread(target=self._watchdog_timer, args=(300,))
         self._stop_whatchdog = threading.Event()
-        self._devices_dict_lock = threading.Lock()
-        self._devices_list_lock = threading.Lock()
         self.watchdog_reset = True
         watchdog_thread.start()
 
@@ -101,52 +276,94 @@ class OTAHandler:
     def start(self):
         self._latest_version = self._check_version()
         print(f"Latest version Available: {self._latest_version}")
+        if self._resume_campaign():
+            return
         print("sending update info to devices...")
-        for device_eui in self._devices_eui_list:
-            with self._devices_dict_lock:
-                self._devices_dict[device_eui] = {
-                    'update_info_reply': False,
-                    'version': None, 
-                    'listening': False, 
-                    'update_finished': False, 
-                }
+        for device_eui in config.DEVICE_EUI:
+            self._devices.add(device_eui)
         self.watchdog_reset = False
-        all_received = False
-        while not all_received:
-            all_received = True
-            for device_eui in self._devices_eui_list:
-                if self._devices_dict[device_eui]['update_info_reply'] == False:
-                    all_received = False
-                    self._send_update_info(device_eui)
-                    time.sleep(8)
+        self._rendezvous = Rendezvous(self._devices.devices(), self._send_update_info, self._rendezvous_rate,
+                                      self._rendezvous_retry_delay, self._rendezvous_max_retry_delay)
+        # returns once every device replied, the replies wake it up
+        self._rendezvous.run()
+        print(f"Update info sent {self._rendezvous.sent} times")
         return
 
     def stop(self):
+        self._campaign_state.clear()
+        self._stop_rendezvous()
         self.stop_thread()
         self.exit = True
         
     def failed_update(self):
+        self._stop_rendezvous()
         self.stop_thread()
         self.failed_exit = True
 
+    def _stop_rendezvous(self):
+        if self._rendezvous is not None:
+            self._rendezvous.stop()
+
     def set_mqtt_client(self, client):
         self.p_client = client
 
     def _init_update_params(self):
         try:
-            print("Creating multicast group...")
-            group_name = self._devices_current_version.strip() + '-' + self._latest_version.strip()
-            # (multicast_id, mcAddr, mcNwkSKey, mcAppSKey)
-            self._multicast_keys = self._clientApp.create_multicast_group(self._downlink_datarate, self._downlink_freq, group_name,
-                                                                        self._loraserver_api_key, self._loraserver_app_id)
-            for device_eui in self._devices_eui_list:
-                print(f"Adding device {device_eui} to multicast group...")
-                self._clientApp.add_device_multicast_group(device_eui, self._multicast_keys[0], self._loraserver_api_key)
-                print(f"Device {device_eui} added to multicast group successfully!")
+            partitions = self._partitions()
+            if not partitions:
+                print("No device can be updated")
+                self.failed_update()
+                return
+            for versions, devices in partitions:
+                if self._delivery(versions[0], devices) == UNICAST:
+                    self._add_unicast_groups(versions, devices)
+                    continue
+                nb_groups = min(len(self._downlink_freqs), len(devices))
+                for index, frequency in enumerate(self._downlink_freqs[:nb_groups]):
+                    print(f"Creating multicast group for {', '.join(versions)} on {frequency} Hz...")
+                    group_name = versions[0].strip() + '-' + self._latest_version.strip()
+                    if len(partitions) > 1 or nb_groups > 1:
+                        group_name += '-' + str(len(self._multicast_groups))
+                    # (multicast_id, mcAddr, mcNwkSKey, mcAppSKey)
+                    multicast_keys = self._clientApp.create_multicast_group(self._downlink_datarate, frequency, group_name,
+                                                                            self._loraserver_api_key, self._loraserver_app_id)
+                    self._add_group({'keys': multicast_keys, 'frequency': frequency, 'versions': versions,
+                                     'devices': devices[index::nb_groups], 'unicast': False, 'finished': False})
+                    # a crash before the transfer starts leaves the group on the network server, the next run deletes it
+                    self._save_campaign_state(transfer_started=False)
+            for group in self._multicast_groups:
+                if group['unicast']:
+                    continue
+                for device_eui in group['devices']:
+                    print(f"Adding device {device_eui} to multicast group...")
+                    self._clientApp.add_device_multicast_group(device_eui, group['keys'][0], self._loraserver_api_key)
+                    print(f"Device {device_eui} added to multicast group successfully!")
         except Exception as e:
             print(f"Error creating update parameters: {e}")
             self.failed_update()
 
+    def _delivery(self, version, devices):
+        if self._delivery_mode != AUTO:
+            return self._delivery_mode
+        return self._cheaper_delivery(version, devices, self._version_patches(version).frame_lengths())
+
+    def _add_unicast_groups(self, versions, devices):
+        # one transfer per device, identified by its EUI
+        for device_eui in devices:
+            self._add_group({'keys': (device_eui,), 'frequency': self._downlink_freqs[0], 'versions': versions,
+                             'devices': [device_eui], 'unicast': True, 'finished': False})
+            # no multicast keys to wait for
+            self._devices.set_listening(device_eui)
+
+    def _add_group(self, group):
+        self._multicast_groups.append(group)
+        self._groups_by_id[group['keys'][0]] = group
+        with self._devices.lock:
+            for device_eui in group['devices']:
+                device = self._devices.get(device_eui)
+                if device is not None:
+                    device.group = group
+
     def _check_version(self):
         latest = '0.0.0'
         for d in os.listdir(self.firmware_dir):
@@ -163,134 +380,103 @@ class OTAHandler:
         else:
             return True
 
-    def delete_multicast_group(self):
-        try:
-            print("deleting multicast group...")
-            self._clientApp.delete_multicast_group(self._multicast_keys[0], self._loraserver_api_key)
-        except Exception as e:
-            print(f"Error deleting multicast group: {e}")
-            self.failed_update()
+    def delete_multicast_group(self, group_id):
+        """Delete the multicast group, return False if the network server still has it."""
+        print("deleting multicast group...")
+        for attempt in range(self.GROUP_DELETE_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(self.GROUP_DELETE_RETRY_DELAY)
+            try:
+                if self._clientApp.delete_multicast_group(group_id, self._loraserver_api_key):
+                    return True
+            except Exception as e:
+                print(f"Error deleting multicast group: {e}")
+        print(f"Multicast group {group_id} could not be deleted, it has to be deleted on the network server")
+        return False
 
 
-    def _create_update_info_msg(self):
-        # $OTA,1,1.17.1,1674930013,*
-        msg = bytearray()
-        msg.extend(self.MSG_HEADER)
-        msg.extend(b',' + str(self.UPDATE_INFO_MSG).encode())
-        msg.extend(b',' + self._latest_version.encode())
-        msg.extend(b',' + str(int(time.time())).encode())
-        msg.extend(b',' + self.MSG_TAIL)
-        return msg
-
     def send_payload(self, dev_eui, data):
-        b64Data = base64.b64encode(data)
-        payload = '{"devEui": "' + dev_eui + '","fPort":1,"data": "' + b64Data.decode() + '"}'
-        topic = "application/" + self._loraserver_app_id  + "/device/" + dev_eui + "/command/down"
-        self.p_client.publish(topic=topic, payload=payload)
+        topic, payload = self._downlink(dev_eui, data)
+        # MQTT_ERR_SUCCESS, the broker is reachable and the message queued
+        return self.p_client.publish(topic=topic, payload=payload).rc == 0
 
 
     def _send_update_info(self, dev_eui):
         msg = self._create_update_info_msg()
         self.send_payload(dev_eui, msg)
         
-    def _send_multicast_keys(self, dev_eui):
-        # $OTA,3,mcAddr,mcNwkSKey,mcAppSKey,*
-        msg = bytearray()
-        msg.extend(self.MSG_HEADER)
-        msg.extend(b',' + str(self.MULTICAST_KEY_MSG).encode())
-
-        msg.extend(b',' + self._multicast_keys[1])
-        msg.extend(b',' + self._multicast_keys[2])
-        msg.extend(b',' + self._multicast_keys[3])
+    def _device_group(self, dev_eui):
+        device = self._devices.get(dev_eui)
+        return device.group if device is not None else None
 
-        msg.extend(b',' + self.MSG_TAIL)
+    def _send_multicast_keys(self, dev_eui):
+        group = self._device_group(dev_eui)
+        msg = self._create_multicast_keys_msg(group['keys'], group['frequency'] if len(self._multicast_groups) > 1 else None)
+        # class A downlink, paced as if it used the multicast channel like RX2 does
+        self._tx_schedulers[group['frequency']].wait(len(msg))
         self.send_payload(dev_eui, msg)
 
-    def get_msg_type(self, msg):
-        msg_type = -1
-
-        try:
-            msg_type = int(msg.split(",")[1])
-        except Exception as ex:
-            print("Exception getting message type")
-
-        return msg_type
-
-    def decode_device_msg(self, payload):
-        dev_msg = None
-        try:
-            rx_pkt = json.loads(payload)
-            dev_msg = base64.b64decode(rx_pkt["data"])
-        except Exception as ex:
-            print("Exception decoding device message")
-        return dev_msg
-    
-    def get_device_eui(self, payload):
-        dev_eui = None
-        try:
-            dev_eui = json.loads(payload)["deviceInfo"]["devEui"]
-        except Exception as ex:
-            print("Exception extracting device eui")
-
-        return dev_eui
+    def _send_multicast_keys_round(self, devices):
+        for dev_eui in devices:
+            self._send_multicast_keys(dev_eui)
+        time.sleep(self.KEYS_REPLY_TIMEOUT)
+        for dev_eui in devices:
+            device = self._devices.get(dev_eui)
+            if device is not None and not device.listening:
+                self._send_multicast_keys(dev_eui)
 
     def _process_update_info_reply(self, dev_eui, msg):
         # $OTA,2,1.17.0,*
-        if dev_eui not in self._devices_eui_list or self._devices_current_version != None:
-            return
         token_msg = msg.split(",")
-        with self._devices_dict_lock:
-            self._devices_dict[dev_eui]['version'] = token_msg[2]
-            self._devices_dict[dev_eui]['update_info_reply'] = True
+        up_to_date = LooseVersion(token_msg[2]) == LooseVersion(self._latest_version)
+        with self._devices.lock:
+            if self._devices_versions is not None or not self._devices.set_version(dev_eui, token_msg[2]):
+                return
+            # if device version is the same as latest version then no update and communications end
+            if up_to_date:
+                self._devices.remove(dev_eui)
+            all_replied = self._devices.all_replied()
+            if all_replied and len(self._devices) > 0:
+                # one sub-campaign per source version
+                self._devices_versions = self._devices.by_version()
+        if self._rendezvous is not None:
+            self._rendezvous.reply(dev_eui)
         print(f"Device {dev_eui} version: {token_msg[2]}")
-
-        # if device version is the same as latest version then no update and communications end
-        if LooseVersion(token_msg[2]) == LooseVersion(self._latest_version):
+        if up_to_date:
             print(f"Device {dev_eui} is up to date to latest version.")
-            with self._devices_list_lock:
-                self._devices_eui_list.remove(dev_eui)
-            with self._devices_dict_lock:
-                self._devices_dict.pop(dev_eui)
-            if len(self._devices_eui_list) == 0:
+            if len(self._devices) == 0:
                 self.stop()
                 return
 
-
-        for device in self._devices_dict:
-            if not self._devices_dict[device]['update_info_reply']:
-                return
-
-        # check if all devices to update have the same version
-        devices_versions = {device: self._devices_dict.get(device, {}).get('version') for device in self._devices_dict}
-        if len(set(devices_versions.values())) > 1:
-            print(f"Devices have different versions: {devices_versions}")
-            self.failed_update()
+        if not all_replied:
             return
-            
-        self._devices_current_version = token_msg[2]
-        time.sleep(5)
-        multi_thread = threading.Thread(target=self._start_multicast_group)
+
+        if len(self._devices_versions) > 1:
+            print("Devices have different versions: {}".format(
+                ', '.join(f"{version} ({len(devices)} devices)" for version, devices in self._devices_versions.items())))
+        # the multicast group setup waits off the MQTT worker
+        multi_thread = threading.Timer(5, self._start_multicast_group)
         multi_thread.start()
         self.watchdog_reset = False
         return
 
     def _process_device_version(self, dev_eui, msg):
         token_msg = msg.split(",")
-        if token_msg[2] != self._latest_version:
-            self._devices_failed_update.append(dev_eui)
-
-        with self._devices_dict_lock:
-            self._devices_dict[dev_eui]['update_finished'] = True
-        
-        for device in self._devices_dict:
-            if self._devices_dict[device]['update_finished'] == False:
+        with self._devices.lock:
+            if not self._devices.set_finished(dev_eui):
                 return
-        
+            if token_msg[2] != self._latest_version:
+                self._devices_failed_update.append(dev_eui)
+            if not self._devices.all_finished():
+                return
+            # the devices skipped for lack of firmware are failed but no longer in the table
+            updated = len(self._devices) - sum(1 for failed in self._devices_failed_update if failed in self._devices)
+
         if len(self._devices_failed_update) == 0:
             print(f"Devices updated succesfully to latest version: {self._latest_version}")
             self.stop()
             return
-        elif len(self._devices_failed_update) == len(self._devices_eui_list):
+        elif updated == 0:
             print(f"All devices failed to update to latest version: {self._latest_version}")
             self.failed_update()
             return
@@ -299,24 +485,204 @@ class OTAHandler:
             self.failed_update()
             return               
 
+    def _resume_campaign(self):
+        state = self._campaign_state.load()
+        if state is None:
+            return False
+        groups_progress = [self._campaign_state.progress(group['keys'][0]) for group in state.get('multicast_groups') or []]
+        # the transfers already drained
+        completed = [progress.get('completed', False) for progress in groups_progress]
+        # saved before the keys were distributed, the devices may not listen to the groups
+        started = state.get('transfer_started', True)
+        if (state.get('latest_version') != self._latest_version or state.get('device_eui') != config.DEVICE_EUI
+                or state.get('downlink_freqs') != self._downlink_freqs or all(completed) or not started):
+            if not started:
+                print("Discarding the campaign state of a transfer that never started")
+            elif all(completed):
+                print("Discarding the campaign state of a finished transfer")
+            else:
+                print("Discarding the campaign state of another update")
+            for group, progress in zip(state.get('multicast_groups') or [], groups_progress):
+                # the groups of the transfers in flight, and those a finished transfer failed to delete
+                if not group.get('unicast') and not progress.get('group_deleted', progress.get('completed', False)):
+                    self.delete_multicast_group(group['keys'][0])
+            self._campaign_state.clear()
+            return False
+
+        self._devices = DeviceTable.from_dict(state['devices'])
+        for group, group_completed in zip(state['multicast_groups'], completed):
+            keys = group['keys']
+            self._add_group({'keys': tuple([keys[0]] + [key.encode() for key in keys[1:]]),
+                             'frequency': group['frequency'], 'versions': group['versions'],
+                             'devices': group['devices'], 'unicast': group['unicast'], 'finished': group_completed})
+        self._devices_versions = self._devices.by_version()
+        print(f"Resuming the update {', '.join(self._devices_versions)} -> {self._latest_version}")
+        self._update_started = True
+        self.watchdog_reset = False
+        update_thread = threading.Thread(target=self.update_process)
+        update_thread.start()
+        return True
+
+    def _save_campaign_state(self, transfer_started=True):
+        # keeps the progress of the groups when resuming
+        self._campaign_state.update(
+            transfer_started=transfer_started,
+            latest_version=self._latest_version,
+            device_eui=config.DEVICE_EUI,
+            downlink_freqs=self._downlink_freqs,
+            multicast_groups=[{'keys': [group['keys'][0]] + [key.decode() for key in group['keys'][1:]],
+                               'frequency': group['frequency'], 'versions': group['versions'],
+                               'devices': group['devices'], 'unicast': group['unicast']}
+                              for group in self._multicast_groups],
+            devices=self._devices.to_dict(),
+        )
+
     def update_process(self):
         print("Devices are ready, starting update process...")
-        update_handler = updateHandler(self._devices_current_version, self._latest_version, self._clientApp, self._loraserver_api_key, self._multicast_keys[0], self)
-        update_handler.start()
+        self._save_campaign_state()
+        handlers = []
+        # a resumed campaign only sends the transfers still in flight
+        groups = [group for group in self._multicast_groups if not group['finished']]
+        try:
+            for group in groups:
+                handler = self._update_handler(group['versions'][0], group)
+                # the groups of a source version get the same patches, built once
+                handler.share_patches(self._version_patches(group['versions'][0]))
+                handlers.append(handler)
+        except Exception as e:
+            print(f"Error preparing the patches: {e}")
+            self.failed_update()
+            return
+        # the groups transmit concurrently, each within the duty cycle of its sub-band
+        threads = [threading.Thread(target=self._group_update, args=(group, handler))
+                   for group, handler in zip(groups, handlers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
         self.update_finished = True
         self.watchdog_reset = False
+
+    def _group_update(self, group, handler):
+        handler.start()
+        group['finished'] = True
+
+    def _version_patches(self, version):
+        """Update handler holding the patches from version to the latest version."""
+        with self._version_handlers_lock:
+            if version not in self._version_handlers:
+                handler = self._update_handler(version)
+                handler.prepare_patches()
+                self._version_handlers[version] = handler
+            return self._version_handlers[version]
+
+    def _partitions(self):
+        """(versions, devices) of every sub-campaign, the versions with identical patches share one."""
+        partitions = dict()
+        for version in sorted(self._devices_versions, key=LooseVersion):
+            if not self._has_source_tree(version):
+                self._skip_devices(version, self._devices_versions[version])
+                continue
+            transfer_hash = self._version_patches(version).transfer_hash()
+            versions, devices = partitions.setdefault(transfer_hash, ([], []))
+            versions.append(version)
+            devices.extend(self._devices_versions[version])
+        for versions, devices in partitions.values():
+            if len(versions) > 1:
+                print(f"Versions {', '.join(versions)} get the same patches, sharing their multicast groups")
+        return list(partitions.values())
+
+    def _skip_devices(self, version, devices):
+        # reported as failed at the end of the campaign, the other versions are updated
+        print(f"No firmware {version} to build the patches from, its {len(devices)} devices are not updated")
+        with self._devices.lock:
+            for dev_eui in devices:
+                self._devices.remove(dev_eui)
+                self._devices_failed_update.append(dev_eui)
+
+    def _update_handler(self, version, group=None):
+        # without group, only prepares the patches of version
+        group_id = group['keys'][0] if group is not None else None
+        progress = self._campaign_state.progress(group_id) if group is not None else dict()
+        tx_scheduler = self._tx_schedulers[group['frequency']] if group is not None else None
+        unicast_device = group['devices'][0] if group is not None and group['unicast'] else None
+        return updateHandler(version, self._latest_version, self._clientApp, self._loraserver_api_key, group_id, self,
+                                       cache_dir=self._patch_cache_dir, cache_max_size=self._patch_cache_max_size,
+                                       patch_workers=self._patch_workers, bundle_dir=self._patch_bundle_dir,
+                                       patience_ext=self._patch_patience_ext, diff_budget=self._patch_diff_budget,
+                                       optimize=self._patch_optimize, patch_encoding=self._patch_encoding,
+                                       zdict_dir=self._patch_zdict_dir, zdict=self._patch_zdict,
+                                       fec_redundancy=self._patch_fec_redundancy, repair_rounds=self._patch_repair_rounds,
+                                       queue_low_watermark=self._queue_low_watermark,
+                                       queue_high_watermark=self._queue_high_watermark,
+                                       stream=self._patch_stream, campaign_state=self._campaign_state,
+                                       resume_frames=progress.get('sent_frames', 0),
+                                       resume_hash=progress.get('transfer_hash'),
+                                       tx_scheduler=tx_scheduler, unicast_device=unicast_device)
         
+    def _delayed_update_process(self, delay):
+        time.sleep(delay)
+        self.update_process()
+
+    def _group_devices(self, group_id):
+        group = self._groups_by_id.get(group_id)
+        return group['devices'] if group is not None else []
+
+    def clear_repair_replies(self, group_id):
+        with self._repair_cond:
+            for dev_eui in self._group_devices(group_id):
+                self._repair_replies.pop(dev_eui, None)
+
+    def _add_repair_reply(self, dev_eui, missing):
+        if dev_eui not in self._devices:
+            return
+        with self._repair_cond:
+            if missing is None:
+                self._repair_replies[dev_eui] = None
+            else:
+                # a device may split its report over several messages
+                reply = self._repair_replies.get(dev_eui) or dict()
+                self._repair_replies[dev_eui] = reply
+                for session, indexes in missing.items():
+                    reply.setdefault(session, set()).update(indexes)
+            self._repair_cond.notify_all()
+
+    def _process_missing_fragments(self, dev_eui, msg):
+        try:
+            missing = parse_missing_fragments(msg)
+        except ValueError:
+            print(f"Invalid missing fragments message from {dev_eui}: {msg}")
+            return
+        self._add_repair_reply(dev_eui, missing)
+
+    def wait_repair_replies(self, group_id, timeout=None):
+        """Return (complete, missing): whether every device of the multicast group has all the
+        fragments, and the union of the fragments missing on its devices, by session."""
+        devices = [device for device in self._group_devices(group_id) if device in self._devices]
+        with self._repair_cond:
+            self._repair_cond.wait_for(lambda: all(device in self._repair_replies for device in devices),
+                                       self.REPAIR_REPLY_TIMEOUT if timeout is None else timeout)
+            complete = all(device in self._repair_replies and self._repair_replies[device] is None
+                           for device in devices)
+            missing = dict()
+            for device in devices:
+                for session, indexes in (self._repair_replies.get(device) or dict()).items():
+                    missing.setdefault(session, set()).update(indexes)
+        return complete, missing
+
     def _start_multicast_group(self):
         self._init_update_params()
+        if self.failed_exit:
+            return
+        multicast_devices = [device for group in self._multicast_groups if not group['unicast'] for device in group['devices']]
+        if not multicast_devices:
+            # unicast only, no device to wait for
+            self._update_started = True
+            self.update_process()
+            return
         print("Sending multicast keys to devices...")
         self.watchdog_reset = False
-        for dev_eui in self._devices_eui_list:
-            self._send_multicast_keys(dev_eui)
-            time.sleep(10)
-        for dev_eui in self._devices_eui_list:
-            if self._devices_dict[dev_eui]['listening'] == False:
-                self._send_multicast_keys(dev_eui)
-                time.sleep(10)
+        self._send_multicast_keys_round(multicast_devices)
         
     def _watchdog_timer(self, timeout_seconds):
         start_time = time.time()
@@ -335,26 +701,37 @@ class OTAHandler:
     def stop_thread(self):
         self._stop_whatchdog.set()
         
-    def process_rx_msg(self, payload):
+    def droppable_uplink(self, topic, payload):
+        """Whether losing the uplink is harmless: not an update message, or an update info
+        reply the rendezvous asks for again."""
+        return ota_msg_type(payload) in (None, self.UPDATE_INFO_REPLY)
+
+    def process_rx_msg(self, topic, payload):
         # self.watchdog_reset = True
-        dev_eui = self.get_device_eui(payload)
-        dev_msg = self.decode_device_msg(payload)
+        uplink = self._uplink_decoder.decode(topic, payload)
 
-        if self.MSG_HEADER in dev_msg:
-            msg_type = self.get_msg_type(dev_msg.decode())
+        if uplink is not None:
+            dev_eui, dev_msg = uplink
+            msg_type = self.get_msg_type(dev_msg)
             
             if msg_type == self.UPDATE_INFO_REPLY:
-                self._process_update_info_reply(dev_eui, dev_msg.decode())
+                self._process_update_info_reply(dev_eui, dev_msg)
             elif msg_type == self.LISTENING_MSG:
-                with self._devices_dict_lock:
-                    self._devices_dict[dev_eui]['listening'] = True
+                if not self._devices.set_listening(dev_eui):
+                    return
                 print(f"device {dev_eui} is listening")
-                for device in self._devices_dict:
-                    with self._devices_dict_lock:
-                        if self._devices_dict[device]['listening'] == False:
-                            return
-                time.sleep(5)
-                self.update_process()
+                with self._devices.lock:
+                    if not self._devices.all_listening() or self._update_started:
+                        return
+                    self._update_started = True
+                # off the MQTT thread, the repair rounds need the device replies
+                update_thread = threading.Thread(target=self._delayed_update_process, args=(self.UPDATE_START_DELAY,))
+                update_thread.start()
+            elif msg_type == self.MISSING_FRAGMENTS_MSG:
+                self._process_missing_fragments(dev_eui, dev_msg)
+            elif msg_type == self.FRAGMENTS_COMPLETE_MSG:
+                self._add_repair_reply(dev_eui, None)
             elif msg_type == self.DEVICE_VERSION_MSG:
-                if self.update_finished:
-                    self._process_device_version(dev_eui, dev_msg.decode())
+                group = self._device_group(dev_eui)
+                if self.update_finished or (group is not None and group['finished']):
+                    self._process_device_version(dev_eui, dev_msg)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+# Precomputed patch bundles.
+#
+# A bundle holds everything updateHandler needs to run the transmission for a
+# (device version -> latest version) pair: the file operations, the compressed
+# patches and binary deltas with their checksums. Bundles are written at build
+# time by `updater.py precompute` to <bundle_dir>/<latest_version>/<dev_version>.json
+# and loaded by the live campaign instead of diffing the firmware again.
+
+import base64
+import hashlib
+import json
+import os
+
+
+BUNDLE_FORMAT = 1
+
+
+def bundle_path(bundle_dir, dev_version, latest_version):
+    return os.path.join(bundle_dir, latest_version.strip(), dev_version.strip() + '.json')
+
+
+def tree_hash(path):
+    """SHA-1 over the relative paths and contents of every file below path."""
+    h = hashlib.sha1()
+    if not os.path.isdir(path):
+        return h.hexdigest()
+    entries = []
+    for root, _, files in os.walk(path):
+        for f in files:
+            full_path = os.path.join(root, f)
+            entries.append(os.path.relpath(full_path, path))
+    for rel_path in sorted(entries):
+        with open(os.path.join(path, rel_path), 'rb') as f:
+            h.update(rel_path.encode() + b'\0' + hashlib.sha1(f.read()).digest())
+    return h.hexdigest()
+
+
+def _encode_patches(patch_dict):
+    return [[fname, base64.b64encode(compressed).decode(), checksum]
+            for fname, (compressed, checksum) in patch_dict.items()]
+
+
+def _decode_patches(patch_list):
+    # lists keep the transmission order of the files
+    return dict((fname, (base64.b64decode(compressed), checksum))
+                for fname, compressed, checksum in patch_list)
+
+
+def save_bundle(path, fingerprint, oper_dict, patch_dict, delta_dict):
+    bundle = {
+        'format': BUNDLE_FORMAT,
+        'fingerprint': fingerprint,
+        'oper_dict': oper_dict,
+        'patches': _encode_patches(patch_dict),
+        'deltas': _encode_patches(delta_dict),
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(bundle, f)
+    os.replace(tmp_path, path)
+
+
+def load_bundle(path, fingerprint):
+    """Return (oper_dict, patch_dict, delta_dict), or None if there is no usable bundle."""
+    try:
+        with open(path) as f:
+            bundle = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print("Error loading patch bundle {}: {}".format(path, e))
+        return None
+
+    if bundle.get('format') != BUNDLE_FORMAT or bundle.get('fingerprint') != fingerprint:
+        print("Patch bundle {} is outdated, ignoring it".format(path))
+        return None
+    return bundle['oper_dict'], _decode_patches(bundle['patches']), _decode_patches(bundle['deltas'])
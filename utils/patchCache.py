@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Content-addressed on-disk cache for generated file patches.
+#
+# Entries are keyed by the SHA-1 of the source and target file contents plus
+# the diff settings used to build the patch, so a version pair that was already
+# processed by a previous campaign does not need to be diffed again.
+#
+# The size of the cache is kept as a running total, read from the disk once
+# and whenever the cache goes over max_size. Eviction then removes the least
+# recently used entries down to EVICT_RATIO of max_size, so the cache tree is
+# not walked again before a good share of it was rewritten.
+
+import base64
+import hashlib
+import json
+import os
+import threading
+
+
+class PatchCache:
+
+    ENTRY_EXT = '.patch'
+    EVICT_RATIO = 0.9
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # bytes of the entries, other processes sharing the directory are only seen when evicting
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        """(mtime, size, path) of every entry."""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(self.ENTRY_EXT):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def make_key(self, left_data, right_data, settings):
+        h = hashlib.sha1()
+        for data in (left_data, right_data):
+            if type(data) is not bytes:
+                data = data.encode()
+            h.update(hashlib.sha1(data).digest())
+        h.update(json.dumps(settings, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + self.ENTRY_EXT)
+
+    def get(self, key):
+        """Return (patch, compressed_patch, checksum, strategy) or None on a cache miss."""
+        path = self._entry_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            # touch the entry so eviction keeps recently used patches
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if 'patch_bin' in entry:
+            patch = base64.b64decode(entry['patch_bin'])
+        else:
+            patch = entry['patch']
+        return (patch, base64.b64decode(entry['compressed']), entry['checksum'], entry.get('strategy', 'default'))
+
+    def put(self, key, patch, compressed_patch, checksum, strategy='default'):
+        path = self._entry_path(key)
+        entry = {
+            'compressed': base64.b64encode(compressed_patch).decode(),
+            'checksum': checksum,
+            'strategy': strategy,
+        }
+        if type(patch) is bytes:
+            entry['patch_bin'] = base64.b64encode(patch).decode()
+        else:
+            entry['patch'] = patch
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.{}.tmp'.format(os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+            size = os.path.getsize(tmp_path)
+            try:
+                # an entry written again replaces the previous one
+                size -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print("Error writing patch cache entry: {}".format(e))
+            return
+        with self._lock:
+            self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # called with the lock held
+        entries = self._entries()
+        total_size = sum(size for _, size, _ in entries)
+        # least recently used entries go first
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size * self.EVICT_RATIO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+        self._size = total_size
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# Compact binary serialisation of diff_match_patch patches, sent over the air
+# instead of patch_toText().
+#
+# patch_toText() emits "@@ -a,b +c,d @@" headers and URL-escapes every line,
+# which inflates the patch before it is compressed. This format keeps the
+# texts as raw UTF-8 and all the numbers as varints:
+#
+#   MAGIC | patch*
+#   patch: zigzag varint(start1 - previous start1) | zigzag varint(start2 - start1)
+#          | varint(number of diffs) | diff*
+#   diff:  varint(UTF-8 length << 2 | op) | UTF-8 text
+#
+# with op 0 for an equality, 1 for an insertion and 2 for a deletion. A zigzag
+# varint stores a signed value v as varint(2v) if v >= 0, else varint(-2v - 1),
+# as in binaryDelta. Offsets
+# are counted in characters like diff_match_patch does. length1 and length2
+# are not stored, they are the lengths of the source and target side of the
+# diffs.
+#
+# decode_patches() is the reference decoder for the device side and only uses
+# operations available in MicroPython.
+
+from .binaryDelta import encode_varint, decode_varint, _zigzag, _unzigzag
+from .diff_match_patch import diff_match_patch, patch_obj
+
+MAGIC = b'BP1'
+
+_OP_CODES = {
+    diff_match_patch.DIFF_EQUAL: 0,
+    diff_match_patch.DIFF_INSERT: 1,
+    diff_match_patch.DIFF_DELETE: 2,
+}
+_OPS = (diff_match_patch.DIFF_EQUAL, diff_match_patch.DIFF_INSERT, diff_match_patch.DIFF_DELETE)
+
+
+def encode_patches(patches):
+    """Serialise a list of patch_obj to bytes."""
+    out = bytearray(MAGIC)
+    previous_start = 0
+    for patch in patches:
+        encode_varint(out, _zigzag(patch.start1 - previous_start))
+        encode_varint(out, _zigzag(patch.start2 - patch.start1))
+        encode_varint(out, len(patch.diffs))
+        for op, text in patch.diffs:
+            data = text.encode('utf-8')
+            encode_varint(out, (len(data) << 2) | _OP_CODES[op])
+            out.extend(data)
+        previous_start = patch.start1
+    return bytes(out)
+
+
+def decode_patches(data, patch_cls=patch_obj):
+    """Rebuild the list of patches serialised by encode_patches()."""
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Invalid binary patch header")
+    patches = []
+    pos = len(MAGIC)
+    previous_start = 0
+    while pos < len(data):
+        patch = patch_cls()
+        value, pos = decode_varint(data, pos)
+        patch.start1 = previous_start + _unzigzag(value)
+        value, pos = decode_varint(data, pos)
+        patch.start2 = patch.start1 + _unzigzag(value)
+        count, pos = decode_varint(data, pos)
+        for _ in range(count):
+            value, pos = decode_varint(data, pos)
+            length = value >> 2
+            op = _OPS[value & 3]
+            text = bytes(data[pos:pos + length]).decode('utf-8')
+            pos += length
+            patch.diffs.append((op, text))
+            if op != diff_match_patch.DIFF_INSERT:
+                patch.length1 += len(text)
+            if op != diff_match_patch.DIFF_DELETE:
+                patch.length2 += len(text)
+        previous_start = patch.start1
+        patches.append(patch)
+    return patches
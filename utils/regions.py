@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# LoRaWAN regional parameters used to pace and size the downlinks.
+#
+# DATARATES maps every downlink data rate of a region to its modulation, (SF,
+# bandwidth in Hz) for LoRa or ('FSK', bitrate) for FSK. US915 and AU915 only
+# send downlinks at DR8-DR13, their lower data rates are uplink only. DUTY_CYCLE_BANDS lists the
+# regulatory sub-bands (lowest frequency, highest frequency, duty cycle) of
+# the regions that enforce a duty cycle (ETSI EN 300 220 for EU868).
+# MAX_PAYLOAD is the maximum downlink application payload (N, not repeater
+# compatible) per data rate, with and without the 400 ms dwell time limit.
+
+FSK = 'FSK'
+
+_EU_DATARATES = {
+    0: (12, 125000),
+    1: (11, 125000),
+    2: (10, 125000),
+    3: (9, 125000),
+    4: (8, 125000),
+    5: (7, 125000),
+    6: (7, 250000),
+    7: (FSK, 50000),
+}
+
+DATARATES = {
+    'EU868': _EU_DATARATES,
+    'AS923': _EU_DATARATES,
+    'US915': {
+        8: (12, 500000),
+        9: (11, 500000),
+        10: (10, 500000),
+        11: (9, 500000),
+        12: (8, 500000),
+        13: (7, 500000),
+    },
+    'AU915': {
+        8: (12, 500000),
+        9: (11, 500000),
+        10: (10, 500000),
+        11: (9, 500000),
+        12: (8, 500000),
+        13: (7, 500000),
+    },
+}
+
+DUTY_CYCLE_BANDS = {
+    'EU868': [
+        (863000000, 865000000, 0.001),
+        (865000000, 868000000, 0.01),
+        (868000000, 868600000, 0.01),
+        (868700000, 869200000, 0.001),
+        (869400000, 869650000, 0.1),
+        (869700000, 870000000, 0.01),
+    ],
+}
+
+_EU_MAX_PAYLOAD = {0: 51, 1: 51, 2: 51, 3: 115, 4: 242, 5: 242, 6: 242, 7: 242}
+_US_AU_MAX_PAYLOAD = {8: 53, 9: 129, 10: 242, 11: 242, 12: 242, 13: 242}
+
+# region -> dwell time limit -> data rate -> bytes
+MAX_PAYLOAD = {
+    'EU868': {
+        False: _EU_MAX_PAYLOAD,
+    },
+    'AS923': {
+        False: _EU_MAX_PAYLOAD,
+        True: {2: 11, 3: 53, 4: 125, 5: 242, 6: 242, 7: 242},
+    },
+    # the 400 ms dwell time only restricts their uplink data rates
+    'US915': {
+        False: _US_AU_MAX_PAYLOAD,
+    },
+    'AU915': {
+        False: _US_AU_MAX_PAYLOAD,
+    },
+}
+
+REGIONS = list(DATARATES)
+
+
+def datarate(region, dr):
+    try:
+        return DATARATES[region][dr]
+    except KeyError:
+        raise ValueError("Data rate DR{} is not a downlink data rate of region {}".format(dr, region))
+
+
+def max_payload(region, dr, dwell_time=False):
+    """Largest application payload in bytes, the dwell time only matters where the region defines it."""
+    tables = MAX_PAYLOAD[region]
+    table = tables[dwell_time] if dwell_time in tables else tables[False]
+    if dr not in table:
+        raise ValueError("Data rate DR{} can not be used in region {}{}".format(
+            dr, region, ' with the dwell time limit' if dwell_time else ''))
+    return table[dr]
+
+
+def duty_cycle_band(region, frequency):
+    """(low, high, duty cycle) sub-band of frequency, None when the region has no duty cycle limit."""
+    if region not in DUTY_CYCLE_BANDS:
+        return None
+    for band in DUTY_CYCLE_BANDS[region]:
+        if band[0] <= frequency <= band[1]:
+            return band
+    raise ValueError("Frequency {} Hz is outside the {} sub-bands".format(frequency, region))
+
+
+def duty_cycle(region, frequency):
+    """Duty cycle of the sub-band of frequency, None when the region has no duty cycle limit."""
+    band = duty_cycle_band(region, frequency)
+    return band[2] if band is not None else None
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# Query of the device versions before an update.
+#
+# Rendezvous sends UPDATE_INFO to every device as fast as the rate limiter
+# allows and gives each device its own retry deadline. A device that has not
+# replied by its deadline is asked again, with an exponentially growing and
+# jittered delay so the retries of a large fleet do not line up. The
+# dispatcher sleeps until the next deadline and is woken up by the replies, the
+# query phase takes about the fleet size divided by the downlink rate.
+
+import heapq
+import random
+import threading
+import time
+
+# relative spread of the retry delays
+RETRY_JITTER = 0.25
+
+
+class RateLimiter:
+    """Token bucket of rate tokens per second, up to burst tokens."""
+
+    def __init__(self, rate, burst=1):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+
+    def delay(self):
+        """Seconds until a token is available, 0 if one is."""
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self._rate
+
+    def take(self):
+        self._tokens -= 1
+
+
+class Rendezvous:
+
+    def __init__(self, devices, send, rate, retry_delay, max_retry_delay, jitter=RETRY_JITTER, rng=None):
+        self._send = send
+        self._limiter = RateLimiter(rate)
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._jitter = jitter
+        self._rng = rng if rng is not None else random.Random()
+        self._cond = threading.Condition()
+        self._pending = set(devices)
+        self._stopped = False
+        # (deadline, dev_eui, attempts), every device is due right away
+        self._deadlines = [(0, dev_eui, 0) for dev_eui in devices]
+        heapq.heapify(self._deadlines)
+        self.sent = 0
+
+    def reply(self, dev_eui):
+        """Record the reply of dev_eui, it is not asked again."""
+        with self._cond:
+            self._pending.discard(dev_eui)
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _next_delay(self, attempts):
+        delay = min(self._retry_delay * 2 ** (attempts - 1), self._max_retry_delay)
+        return delay * (1 + self._rng.uniform(-self._jitter, self._jitter))
+
+    def _next_device(self):
+        """Wait for the next device to query, None once every device replied or when stopped."""
+        with self._cond:
+            while self._pending and not self._stopped:
+                # the devices that replied are dropped when their deadline comes
+                while self._deadlines[0][1] not in self._pending:
+                    heapq.heappop(self._deadlines)
+                wait = self._deadlines[0][0] - time.monotonic()
+                if wait <= 0:
+                    wait = self._limiter.delay()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                _, dev_eui, attempts = heapq.heappop(self._deadlines)
+                self._limiter.take()
+                heapq.heappush(self._deadlines, (time.monotonic() + self._next_delay(attempts + 1), dev_eui, attempts + 1))
+                self.sent += 1
+                return dev_eui
+            return None
+
+    def run(self):
+        """Query the devices until all of them replied, return False if stopped before."""
+        dev_eui = self._next_device()
+        while dev_eui is not None:
+            self._send(dev_eui)
+            dev_eui = self._next_device()
+        with self._cond:
+            return not self._pending
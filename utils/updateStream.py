@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Single update stream holding every file operation of an update.
+#
+# Compressing the patches of a release together lets zlib reuse what the
+# files have in common, and the stream is framed once instead of paying the
+# file name and checksum messages of every file. Before compression:
+#
+#   MAGIC | record*
+#   record: varint(op) | varint(name length) | name
+#           | varint(payload length) | payload | SHA-1 of the payload (20 bytes)
+#
+# op is one of the OP_* values below. A delete record has an empty payload.
+# The payloads are the uncompressed patches, patch_toText or patchCodec
+# output, and binaryDelta deltas, their SHA-1 is the per file checksum of the
+# non stream mode. decode_stream() is the reference decoder for the device.
+
+from .binaryDelta import encode_varint, decode_varint
+import hashlib
+
+MAGIC = b'US1'
+
+OP_DELETE = 0
+OP_TEXT_PATCH = 1
+OP_BIN_PATCH = 2
+OP_DELTA = 3
+
+_HASH_SIZE = 20
+
+
+def encode_stream(records):
+    """Serialise (op, name, payload) records, payload being bytes."""
+    out = bytearray(MAGIC)
+    for op, name, payload in records:
+        name = name.encode('utf-8')
+        encode_varint(out, op)
+        encode_varint(out, len(name))
+        out.extend(name)
+        encode_varint(out, len(payload))
+        out.extend(payload)
+        out.extend(hashlib.sha1(payload).digest())
+    return bytes(out)
+
+
+def decode_stream(data):
+    """Return the (op, name, payload) records, checking the hash of every payload."""
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Invalid update stream header")
+    records = []
+    pos = len(MAGIC)
+    while pos < len(data):
+        op, pos = decode_varint(data, pos)
+        length, pos = decode_varint(data, pos)
+        name = bytes(data[pos:pos + length]).decode('utf-8')
+        pos += length
+        length, pos = decode_varint(data, pos)
+        payload = bytes(data[pos:pos + length])
+        pos += length
+        if hashlib.sha1(payload).digest() != bytes(data[pos:pos + _HASH_SIZE]):
+            raise ValueError("Checksum mismatch for {}".format(name))
+        pos += _HASH_SIZE
+        records.append((op, name, payload))
+    return records
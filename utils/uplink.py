@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# Decoding of the device uplinks received over MQTT.
+#
+# The network server publishes the uplinks of every device on
+# application/<app>/device/<devEUI>/event/up. UplinkDecoder reads the devEUI
+# from the topic and looks for the base64 encoded "$OTA" header in the raw
+# payload, so the uplinks of other devices and the application traffic of the
+# fleet are dropped before any JSON parsing. The remaining uplinks are parsed
+# once, with orjson when it is installed.
+
+import base64
+import binascii
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# "$OTA," base64 encoded starts with JE9UQ, whatever follows the comma
+OTA_DATA = re.compile(rb'"data"\s*:\s*"' + re.escape(base64.b64encode(b'$OTA,')[:5]))
+# the first 12 characters hold "$OTA,<type>," for types of up to two digits
+_OTA_DATA_HEAD = re.compile(rb'"data"\s*:\s*"(JE9UQ[A-Za-z0-9+/=]{7})')
+
+
+def json_loads():
+    """Fastest JSON parser available."""
+    return orjson.loads if orjson is not None else json.loads
+
+
+def topic_device_eui(topic):
+    """devEUI of an uplink topic, None if it is not one."""
+    # application/<app>/device/<devEUI>/event/up
+    parts = topic.split('/')
+    if len(parts) != 6 or parts[2] != 'device':
+        return None
+    return parts[3]
+
+
+def ota_msg_type(payload):
+    """Type of an OTA uplink read from the start of its data without parsing it, None for any other uplink."""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    match = _OTA_DATA_HEAD.search(payload)
+    if match is None:
+        return None
+    try:
+        return int(base64.b64decode(match.group(1)).split(b',')[1])
+    except (IndexError, ValueError, binascii.Error):
+        return None
+
+
+class UplinkDecoder:
+    """Extracts the OTA messages of the fleet devices from the MQTT uplinks."""
+
+    def __init__(self, devices, loads=None):
+        # anything supporting in, looked up on every uplink
+        self._devices = devices
+        self._loads = loads if loads is not None else json_loads()
+
+    def decode(self, topic, payload):
+        """(devEUI, message) of an OTA uplink of the fleet, None for any other uplink."""
+        dev_eui = topic_device_eui(topic)
+        if dev_eui not in self._devices:
+            return None
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if OTA_DATA.search(payload) is None:
+            return None
+        try:
+            msg = base64.b64decode(self._loads(payload)['data']).decode()
+        except (ValueError, KeyError, TypeError, binascii.Error):
+            print(f"Exception decoding device message from {dev_eui}")
+            return None
+        return dev_eui, msg
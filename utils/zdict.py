@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Preset dictionaries for the patch compression.
+#
+# Most patches are a few hundred bytes, too short for zlib to find repetitions
+# in its own output. A preset dictionary built from the firmware history
+# (library code, common MicroPython identifiers) gives the compressor
+# something to reference from the first byte.
+#
+# Dictionaries are identified by the Adler-32 checksum of their contents, the
+# same value zlib stores as DICTID in the header of every stream compressed
+# with them, so a device can pick the right one from the stream itself. They
+# are saved as <zdict_dir>/<id>.zdict and have to be installed on the devices
+# before a campaign uses them.
+
+import os
+import re
+import urllib.parse
+import zlib
+from collections import Counter
+
+
+ZDICT_MAX_SIZE = 32 * 1024
+ZDICT_EXT = '.zdict'
+# compression level of the patches compressed with a dictionary
+ZDICT_LEVEL = 9
+
+# Candidates shorter than this are cheaper to encode as literals.
+_MIN_CANDIDATE_LENGTH = 4
+_IDENTIFIER_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_.]{3,}')
+
+# dictionaries available to compress(), by id
+_zdicts = dict()
+
+
+def zdict_id(zdict):
+    return '{:08x}'.format(zlib.adler32(zdict))
+
+
+def register_zdicts(zdicts):
+    """Make the dictionaries available to compress(), also used as process pool initializer."""
+    for zdict in zdicts:
+        _zdicts[zdict_id(zdict)] = zdict
+
+
+def get_zdict(zdict_id):
+    return _zdicts[zdict_id]
+
+
+def _escape(line):
+    # same escaping as patch_obj.__str__
+    return urllib.parse.quote(line.encode('utf-8'), "!~*'();/?:@&=+$,# ")
+
+
+def build_zdict(firmware_dir, encoding='text', binary_ext=(), max_size=ZDICT_MAX_SIZE):
+    """Build a dictionary from the text files of every version in firmware_dir.
+
+    Lines and identifiers are scored by how many bytes they cover in the
+    history. The best ones are packed until max_size, with the most valuable at
+    the end of the dictionary where they are the cheapest to reference.
+    """
+    counts = Counter()
+    for root, _, files in os.walk(firmware_dir):
+        for f in files:
+            if os.path.splitext(f)[1] in binary_ext:
+                continue
+            try:
+                with open(os.path.join(root, f)) as fd:
+                    text = fd.read()
+            except (OSError, UnicodeDecodeError):
+                continue
+            for line in text.splitlines(True):
+                if len(line.strip()) >= _MIN_CANDIDATE_LENGTH:
+                    counts[line] += 1
+            counts.update(_IDENTIFIER_RE.findall(text))
+
+    candidates = []
+    for candidate, count in counts.items():
+        if encoding == 'text':
+            candidate = _escape(candidate)
+        candidates.append((count * len(candidate), candidate))
+    candidates.sort(reverse=True)
+
+    chosen = []
+    chosen_text = ''
+    size = 0
+    for _, candidate in candidates:
+        if max_size - size < _MIN_CANDIDATE_LENGTH:
+            break
+        data = candidate.encode('utf-8')
+        if size + len(data) > max_size:
+            continue
+        # identifiers are often already part of a chosen line
+        if candidate in chosen_text:
+            continue
+        chosen.append(candidate)
+        chosen_text += '\n' + candidate
+        size += len(data)
+
+    chosen.reverse()
+    return ''.join(chosen).encode('utf-8')
+
+
+def save_zdict(zdict_dir, zdict):
+    os.makedirs(zdict_dir, exist_ok=True)
+    path = os.path.join(zdict_dir, zdict_id(zdict) + ZDICT_EXT)
+    with open(path, 'wb') as f:
+        f.write(zdict)
+    return path
+
+
+def load_zdict(zdict_dir, zdict_id_str):
+    with open(os.path.join(zdict_dir, zdict_id_str + ZDICT_EXT), 'rb') as f:
+        zdict = f.read()
+    if zdict_id(zdict) != zdict_id_str:
+        raise ValueError("Dictionary {} does not match its id".format(zdict_id_str))
+    register_zdicts([zdict])
+    return zdict
+
+
+def compress(data, zdict_id_str=None):
+    if not zdict_id_str:
+        return zlib.compress(data)
+    compressor = zlib.compressobj(level=ZDICT_LEVEL, zdict=get_zdict(zdict_id_str))
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, zdict):
+    """Reference decoder for the device side, the DICTID of the stream header is
+    the id of the dictionary to use."""
+    decompressor = zlib.decompressobj(zdict=zdict)
+    return decompressor.decompress(data) + decompressor.flush()